@@ -0,0 +1,519 @@
+"""Serve LuaFlask from an asyncio event loop, for any ASGI server.
+
+Run it with e.g. `uvicorn asgi:app --host 0.0.0.0 --port 80`. Lua routes run
+as coroutines on one Lua runtime owned by the event loop, and api.util.sleep,
+api.http.* and api.util.dnsLookup hand their wait to the loop instead of
+blocking a thread, so a slow upstream only costs a suspended coroutine.
+Everything else (static files, .shtml, cached routes, /metrics...) is passed to
+the Flask app on a thread pool.
+"""
+
+import asyncio
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import dns.asyncresolver
+from flask import Response, g, redirect, request
+
+import main
+
+try:
+    import httpx
+except ImportError:  # api.http then runs requests on main.httpExecutor
+    httpx = None
+
+# Lua side of the coroutine driver. Request handlers and streamed bodies run
+# as coroutines; an api function that waits yields (marker, name, args...) and
+# is resumed with (true, result) or (false, error) once the loop is done.
+ASYNC_DRIVER = """
+local limits = ...
+-- coroutine.create is LuaState's version, which hooks each coroutine as it
+-- starts, so the limits armed below also reach coroutines a script makes
+local create, resume, yield, running, status, isyieldable, close =
+    coroutine.create, coroutine.resume, coroutine.yield, coroutine.running,
+    coroutine.status, coroutine.isyieldable, coroutine.close
+local pack, unpack = table.pack, table.unpack
+local marker = {}
+local threads, nextId = {}, 0
+local driven = setmetatable({}, {__mode = "k"})
+local driver = {}
+
+-- Threads stay on the Lua side (lupa turns them into functions), Python
+-- refers to them by id
+local function track(thread)
+    nextId = nextId + 1
+    threads[nextId], driven[thread] = thread, true
+    return nextId
+end
+
+local function finish(ok, ...)
+    if not ok then error(..., 2) end
+    return ...
+end
+
+-- Only a coroutine we drive can wait on the loop. Module code, a coroutine the
+-- script made itself, or a call from inside a C function just blocks like before
+function driver.wrap(name, blocking)
+    return function(...)
+        if driven[running()] and isyieldable() then
+            return finish(yield(marker, name, ...))
+        end
+        return blocking(...)
+    end
+end
+
+function driver.start(handler)
+    return track(create(handler))
+end
+
+-- Turn a streamed response body into a coroutine id, the same way
+-- LuaState.prepareResult does for the threaded server
+function driver.prepare(result)
+    local body = type(result) == "table" and result.response
+    if type(body) == "thread" then
+        return result, track(body)
+    elseif type(body) == "function" then
+        return result, track(create(function()
+            while true do
+                local chunk = body()
+                if chunk == nil then return nil end
+                yield(chunk)
+            end
+        end))
+    end
+    return result, nil
+end
+
+-- Run a coroutine until it finishes, yields a chunk or waits, within the
+-- instructions and seconds it has left. Returns the outcome and the
+-- instructions left, then the values (or the error message and which limit)
+function driver.resume(id, instructions, seconds, ...)
+    local thread = threads[id]
+    limits.arm(instructions, seconds, nil, thread)
+    local results = pack(resume(thread, ...))
+    limits.armed = false
+    limits.disarm(thread)
+    local remaining = limits.remaining()
+    if not results[1] then
+        threads[id] = nil
+        local message = tostring(results[2])
+        local kind = limits.exceeded or (message == "not enough memory" and "memory") or nil
+        return "error", remaining, message, kind
+    end
+    if status(thread) == "dead" then
+        threads[id] = nil
+        return "done", remaining, unpack(results, 2, results.n)
+    end
+    if results[2] == marker then
+        return "wait", remaining, unpack(results, 3, results.n)
+    end
+    return "yield", remaining, unpack(results, 2, results.n)
+end
+
+function driver.close(id)
+    local thread = threads[id]
+    threads[id] = nil
+    if thread then close(thread) end
+end
+
+return driver
+"""
+
+httpClient = None
+
+
+def getHttpClient():
+    """The shared httpx client, created on first use so it belongs to the running loop."""
+    global httpClient
+    if httpClient is None:
+        httpClient = httpx.AsyncClient(
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_keepalive_connections=main.app.config["HTTP_POOL_HOSTS"]
+                * main.app.config["HTTP_POOL_PER_HOST"]
+            ),
+        )
+    return httpClient
+
+
+async def sendHttpRequest(method, url, data=None, headers=None, timeout=None):
+    """Like main.sendHttpRequest, but waits on the event loop."""
+    if httpx is None:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            main.httpExecutor, main.sendHttpRequest, method, url, data, headers, timeout
+        )
+    try:
+        response = await getHttpClient().request(
+            method,
+            url,
+            content=data,
+            headers=headers,
+            timeout=timeout or main.app.config["HTTP_TIMEOUT"],
+        )
+        return {"status": response.status_code, "data": response.text}
+    except (httpx.HTTPError, httpx.InvalidURL) as e:
+        return {"status": 500, "data": f"Error: {str(e)}"}
+
+
+class AsyncApi:
+    """The api functions that wait, as coroutines. Each gets the LuaRuntime first."""
+
+    @staticmethod
+    async def sleep(lua, seconds):
+        await asyncio.sleep(seconds)
+
+    @staticmethod
+    async def get(lua, url, headers=None):
+        result = await sendHttpRequest("GET", url, headers=dict(headers) if headers else None)
+        return lua.table_from(result)
+
+    @staticmethod
+    async def post(lua, url, data=None, headers=None):
+        result = await sendHttpRequest(
+            "POST",
+            url,
+            data=None if data is None else str(data),
+            headers=dict(headers) if headers else None,
+        )
+        return lua.table_from(result)
+
+    @staticmethod
+    async def batch(lua, specs):
+        requestArgs = [
+            main.httpRequestArgs(specs[index]) for index in range(1, len(specs) + 1)
+        ]
+        results = await asyncio.gather(*(sendHttpRequest(*args) for args in requestArgs))
+        return lua.table_from([lua.table_from(result) for result in results])
+
+    @staticmethod
+    async def dnsLookup(lua, domain):
+        try:
+            answers = await dns.asyncresolver.resolve(domain, "A")
+            return [answer.to_text() for answer in answers]
+        except Exception as e:
+            return str(e)
+
+
+# api function -> its AsyncApi version
+ASYNC_OPERATIONS = {
+    "util.sleep": AsyncApi.sleep,
+    "http.get": AsyncApi.get,
+    "http.post": AsyncApi.post,
+    "http.batch": AsyncApi.batch,
+    "util.dnsLookup": AsyncApi.dnsLookup,
+}
+
+
+class RouteError(Exception):
+    """A Lua route failed; kind is the limit it went over, if any."""
+
+    def __init__(self, message, kind=None):
+        super().__init__(message)
+        self.kind = kind
+
+
+class AsyncLuaRuntime:
+    """A LuaState shared by every request on the loop, each one in its own coroutine."""
+
+    def __init__(self):
+        self.state = main.LuaState()
+        lua = self.state.lua
+        self.driver = self.state.compileChunk(
+            ASYNC_DRIVER, "asgi.py:ASYNC_DRIVER", self.state.limits
+        )
+
+        # Give this runtime its own api table, with the waiting functions
+        # swapped for ones that yield to the loop
+        api = lua.table()
+        for name, namespace in self.state.api.items():
+            if main.lua_type(namespace) != "table":
+                functions = lua.table()
+                for attribute in dir(namespace):
+                    if not attribute.startswith("_"):
+                        functions[attribute] = getattr(namespace, attribute)
+                namespace = functions
+            api[name] = namespace
+        for operation in ASYNC_OPERATIONS:
+            name, attribute = operation.split(".")
+            api[name][attribute] = self.driver.wrap(operation, api[name][attribute])
+        lua.globals().api = self.state.api = api
+
+    async def run(self, coroutineId, instructions, deadline, *values):
+        """Resume a coroutine until it returns or yields a chunk, doing its waits on the loop.
+
+        Returns ("done" or "yield", values), or raises RouteError.
+        """
+        while True:
+            seconds = 0
+            if deadline:
+                seconds = deadline - time.perf_counter()
+                if seconds <= 0:
+                    raise RouteError("Lua route timed out", "timeout")
+            with main.useLuaState(self.state):
+                outcome, instructions, *values = self.driver.resume(
+                    coroutineId, instructions, seconds, *values
+                )
+            if outcome == "error":
+                raise RouteError(*values)
+            if outcome != "wait":
+                return outcome, values
+
+            name, *arguments = values
+            try:
+                operation = ASYNC_OPERATIONS[name](self.state.lua, *arguments)
+                if deadline:
+                    operation = asyncio.wait_for(operation, deadline - time.perf_counter())
+                values = (True, await operation)
+            except asyncio.TimeoutError:
+                raise RouteError("Lua route timed out", "timeout")
+            except Exception as e:
+                values = (False, str(e))
+
+    async def stream(self, streamId, instructions, timeout):
+        """Yield a streamed body's chunks. Each chunk gets the route's limits afresh."""
+        while True:
+            deadline = time.perf_counter() + timeout if timeout else 0
+            outcome, values = await self.run(streamId, instructions, deadline)
+            chunk = values[0] if values else None
+            if chunk is not None and chunk != "":
+                if not isinstance(chunk, (str, bytes)):
+                    chunk = str(chunk)
+                yield chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+            if outcome == "done" or chunk is None:
+                return
+
+
+def buildEnviron(scope, body):
+    """A WSGI environ for an ASGI http scope whose body has already been read."""
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    server = scope.get("server") or ("localhost", 80)
+    environ["SERVER_NAME"], environ["SERVER_PORT"] = server[0], str(server[1] or 80)
+    if scope.get("client"):
+        environ["REMOTE_ADDR"], environ["REMOTE_PORT"] = scope["client"][0], str(scope["client"][1])
+
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_LENGTH":
+            continue
+        if name != "CONTENT_TYPE":
+            name = "HTTP_" + name
+        if name in environ:
+            value = environ[name] + "," + value
+        environ[name] = value
+    return environ
+
+
+async def readBody(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    return b"".join(chunks)
+
+
+async def sendStart(send, status, headers):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in headers
+            ],
+        }
+    )
+
+
+class LuaFlaskAsgi:
+    """The ASGI app: Lua routes on the event loop, everything else through Flask."""
+
+    def __init__(self):
+        self.runtime = None
+        self.wsgiExecutor = ThreadPoolExecutor(main.app.config["ASGI_WSGI_THREADS"])
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        if self.runtime is None:
+            self.runtime = AsyncLuaRuntime()
+
+        body = await readBody(receive)
+        # Flask's request context lives in a context variable, so each request
+        # task gets its own and request, g and the Flask hooks work as usual
+        with main.app.request_context(buildEnviron(scope, body)):
+            path = self.luaRoutePath()
+            if path is not None:
+                await self.serveLuaRoute(path, send)
+                return
+        await self.serveWsgi(buildEnviron(scope, body), send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.runtime = AsyncLuaRuntime()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if httpClient is not None:
+                    await httpClient.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def luaRoutePath(self):
+        """The .lua file this request runs on the loop, or None to hand it to Flask."""
+        if request.routing_exception is not None or request.url_rule.endpoint != "routeHandler":
+            return None
+        # Profiling and the response cache live in the threaded request path
+        if main.app.config["PROFILING_ENABLED"] and main.profileRequested():
+            return None
+        route = main.routeIndex.resolve(request.view_args["subpath"])
+        if route is None or route[0] != "lua":
+            return None
+        path = route[1]
+        if main.responseCache.isCacheable(path):
+            return None
+        return path
+
+    async def serveLuaRoute(self, path, send):
+        runtime = self.runtime  # Replacing the runtime mustn't affect this request
+        state = runtime.state
+        instructions = main.app.config["LUA_INSTRUCTION_LIMIT"]
+        timeout = main.routeTimeout(request.view_args["subpath"])
+        deadline = time.perf_counter() + timeout if timeout else 0
+        coroutineId = streamId = None
+
+        response = main.app.preprocess_request()
+        if response is not None:
+            response = main.app.make_response(response)
+        else:
+            g.metricsRoute = os.path.relpath(path)
+            try:
+                with main.useLuaState(state):
+                    requestData = main.getRequestData()
+                    with state.limited(instructions, timeout):
+                        try:
+                            luaFunction = state.routeCache.get(path)
+                        except FileNotFoundError:
+                            luaFunction = None
+                if luaFunction is None:
+                    # Deleted since the route index last looked
+                    main.routeIndex.invalidate(path)
+                    response = main.serveErrorPage("404")
+                else:
+                    with main.useLuaState(state):
+                        coroutineId = runtime.driver.start(luaFunction)
+                    outcome, values = await runtime.run(
+                        coroutineId, instructions, deadline, requestData
+                    )
+                    if outcome != "done":
+                        raise RouteError("Lua route function yielded instead of returning")
+                    with main.useLuaState(state):
+                        result, streamId = runtime.driver.prepare(values[0] if values else None)
+                        result = dict(result)
+                    response = self.buildResponse(path, result, streamId)
+            except Exception as e:
+                kind = e.kind if isinstance(e, RouteError) else state.exceededLimit(e)
+                if kind == "memory":
+                    # The shared runtime may be left in a bad state, so new
+                    # requests get a fresh one
+                    e = "Lua route went over its memory limit"
+                    if self.runtime is runtime:
+                        self.runtime = AsyncLuaRuntime()
+                        state.close()
+                print("Lua Error:", e)
+                response = main.handleLuaError(str(e), main.LIMIT_STATUS.get(kind, 500))
+            finally:
+                if coroutineId is not None:
+                    runtime.driver.close(coroutineId)
+        response = main.app.process_response(response)
+
+        await sendStart(send, response.status_code, response.headers.to_wsgi_list())
+        try:
+            if request.method != "HEAD":
+                if streamId is not None:
+                    try:
+                        async for chunk in runtime.stream(streamId, instructions, timeout):
+                            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                    except Exception as e:
+                        # Headers are already sent, so all we can do is end the stream
+                        print("Lua Error while streaming:", e)
+                else:
+                    for chunk in response.iter_encoded():
+                        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body"})
+        finally:
+            if streamId is not None:
+                runtime.driver.close(streamId)
+
+    def buildResponse(self, path, result, streamId):
+        """Turn a route's result table into a response, like main.handleLuaFile."""
+        if "response" in result:
+            response = Response(
+                iter(()) if streamId is not None else result["response"],
+                status=result.get("code", 200),
+                content_type=result.get("type", "text/plain"),
+                headers=dict(result.get("headers") or {}),
+            )
+            if streamId is None:
+                main.responseCache.store(path, result.get("cache"), response)
+            return response
+        if "_redirect" in result:
+            return redirect(result["_redirect"])
+        print("Error: Invalid response from Lua function.")
+        return main.serveErrorPage("500")
+
+    async def serveWsgi(self, environ, send):
+        """Run the request through the Flask app on a thread and send what it returns."""
+        loop = asyncio.get_running_loop()
+        started = {}
+
+        def startResponse(status, headers, excInfo=None):
+            started["status"], started["headers"] = int(status.split(" ", 1)[0]), headers
+
+        chunks = await loop.run_in_executor(self.wsgiExecutor, main.app, environ, startResponse)
+        try:
+            if isinstance(chunks, (list, tuple)):
+                await sendStart(send, started["status"], started["headers"])
+                await send({"type": "http.response.body", "body": b"".join(chunks)})
+                return
+            # Files and streamed bodies may block, so read them on the thread pool too
+            iterator = iter(chunks)
+            chunk = await loop.run_in_executor(self.wsgiExecutor, next, iterator, None)
+            await sendStart(send, started["status"], started["headers"])
+            while chunk is not None:
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                chunk = await loop.run_in_executor(self.wsgiExecutor, next, iterator, None)
+            await send({"type": "http.response.body"})
+        finally:
+            if hasattr(chunks, "close"):
+                await loop.run_in_executor(self.wsgiExecutor, chunks.close)
+
+
+app = LuaFlaskAsgi()
@@ -0,0 +1,84 @@
+"""Compare api.html.builder() (builder.lua) with the Python api.html.legacyBuilder().
+
+Run from anywhere: python benchmarks/builder_bench.py [--elements 10000] [--rounds 5]
+"""
+
+import argparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import main  # noqa: E402
+
+# Builds a page like routes/_.lua, repeated until it has the requested
+# number of elements: headings, paragraphs and links with attributes
+PAGE = """
+local newBuilder, elements = ...
+local html = newBuilder()
+html:doctype():open("html"):head()
+    :title("Builder benchmark")
+    :meta({charset = "UTF-8"})
+    :link({rel = "stylesheet", href = "/static/styles.css"})
+    :close()
+    :body()
+local count = 0
+while count < elements do
+    html:h2("Section " .. count)
+        :open("p"):plain("Random number: " .. math.random(1, 100)):close()
+        :open("p", {class = "note"}):plain("Some text & more <text>"):close()
+        :a("/page?id=" .. count, {class = "link"}):plain("Go to page " .. count):close()
+    count = count + 4
+end
+return html:finish()
+"""
+
+RUN = """
+local render, newBuilder, elements, rounds = ...
+local page
+local start = os.clock()
+for _ = 1, rounds do page = render(newBuilder, elements) end
+return os.clock() - start, #page
+"""
+
+
+def runBenchmark():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--elements", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    with main.luaPool.checkout() as state:
+        lua = state.lua
+        render = lua.eval(f"function(...) {PAGE} end")
+        run = lua.eval(f"function(...) {RUN} end")
+        html = lua.globals().api.html
+
+        results = {}
+        for name, newBuilder in (
+            ("legacyBuilder (Python)", html.legacyBuilder),
+            ("builder (Lua)", html.builder),
+        ):
+            try:
+                elapsed, size = run(render, newBuilder, args.elements, args.rounds)
+            except Exception as e:
+                # The Python builder hands the same object to Lua over and over,
+                # which can run into lupa's wrapper cache bug (see the import in main.py)
+                print(f"{name:24} failed: {type(e).__name__}: {e}".splitlines()[0])
+                continue
+            results[name] = elapsed
+            print(
+                f"{name:24} {elapsed / args.rounds * 1000:8.1f} ms per page"
+                f"  ({size / 1024:.0f} KiB)"
+            )
+
+        if len(results) < 2:
+            sys.exit("A builder failed, run the benchmark again for a comparison.")
+        python, native = results.values()
+        print(f"speedup: {python / native:.1f}x")
+
+
+if __name__ == "__main__":
+    runBenchmark()
@@ -0,0 +1,78 @@
+"""Compare api.json (Python's json/orjson) with the pure-Lua json.lua.
+
+Run from anywhere: python benchmarks/json_bench.py [--items 10000] [--rounds 5]
+"""
+
+import argparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import main  # noqa: E402
+
+# Builds a payload shaped like a typical API response: a list of records
+PAYLOAD = """
+local items = ...
+local rows = {}
+for i = 1, items do
+    rows[i] = {
+        id = i,
+        name = "item " .. i,
+        price = i * 1.25,
+        tags = {"red", "green", "blue"},
+        active = i % 2 == 0,
+        note = "quote \\" backslash \\\\ newline \\n unicode \\u{e9}",
+    }
+end
+return {count = items, rows = rows}
+"""
+
+RUN = """
+local encoder, payload, rounds = ...
+local text
+local start = os.clock()
+for _ = 1, rounds do text = encoder.encode(payload) end
+local encodeTime = os.clock() - start
+start = os.clock()
+for _ = 1, rounds do encoder.decode(text) end
+return encodeTime, os.clock() - start, #text
+"""
+
+
+def runBenchmark():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    with main.luaPool.checkout() as state:
+        lua = state.lua
+        payload = lua.execute(PAYLOAD, args.items)
+        run = lua.eval(f"function(...) {RUN} end")
+        backend = "orjson" if main.orjson is not None else "json"
+
+        results = {}
+        for name, encoder in (
+            ("json.lua", lua.globals().json),
+            (f"api.json ({backend})", lua.globals().api.json),
+        ):
+            encodeTime, decodeTime, size = run(encoder, payload, args.rounds)
+            results[name] = (encodeTime, decodeTime)
+            print(
+                f"{name:20} encode {encodeTime / args.rounds * 1000:8.1f} ms"
+                f"  decode {decodeTime / args.rounds * 1000:8.1f} ms"
+                f"  ({size / 1024:.0f} KiB)"
+            )
+
+        (luaEncode, luaDecode), (nativeEncode, nativeDecode) = results.values()
+        print(
+            f"speedup: encode {luaEncode / nativeEncode:.1f}x, "
+            f"decode {luaDecode / nativeDecode:.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    runBenchmark()
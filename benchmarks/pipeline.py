@@ -0,0 +1,317 @@
+"""Load-test the whole request pipeline, in-process and through waitress.
+
+Run from anywhere: python benchmarks/pipeline.py [--modes inprocess,waitress]
+    [--concurrency 1,4,16] [--duration 3] [--output results.json] [--compare old.json]
+
+The repo is copied to a temporary folder with a few extra fixture routes, so the
+benchmark never touches your database or routes. Results are saved as JSON
+(benchmarks/results/pipeline-<commit>.json by default) so two commits can be
+compared with --compare.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Extra routes copied into routes/_bench in the temporary tree
+FIXTURES = {
+    "trivial.lua": """
+return function(requestData)
+    return {response = "ok", type = "text/plain"}
+end
+""",
+    "list.lua": """
+return function(requestData)
+    local length = api.list.appendToList("bench", "item")
+    return {response = tostring(api.list.getItem("bench", 1)), type = "text/plain"}
+end
+""",
+    "json.lua": """
+local payload = {}
+for i = 1, 50 do
+    payload[i] = {id = i, name = "item " .. i, tags = {"a", "b"}, active = i % 2 == 0}
+end
+
+return function(requestData)
+    local text = api.json.encode({count = #payload, rows = payload})
+    local decoded = api.json.decode(text)
+    return {response = api.json.encode(decoded.rows[1]), type = "application/json"}
+end
+""",
+}
+
+# name -> (path, expected status)
+SCENARIOS = {
+    "trivial": ("/_bench/trivial", 200),
+    "builder": ("/", 200),
+    "shtml": ("/test.shtml", 200),
+    "static": ("/example.jpg", 200),
+    "notfound": ("/_bench/missing", 404),
+    "list": ("/_bench/list", 200),
+    "json": ("/_bench/json", 200),
+}
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", default="inprocess,waitress")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--concurrency", default="1,4,16")
+    parser.add_argument("--duration", type=float, default=3, help="seconds per run")
+    parser.add_argument("--warmup", type=float, default=0.5, help="seconds before each run")
+    parser.add_argument("--threads", type=int, default=16, help="waitress threads")
+    parser.add_argument("--output", help="where to save the results as JSON")
+    parser.add_argument("--compare", help="earlier results to compare against")
+    return parser.parse_args()
+
+
+def gitCommit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def copyTree(target):
+    """Copy the repo into target, leaving out git data, databases and old results."""
+    shutil.copytree(
+        ROOT,
+        target,
+        ignore=shutil.ignore_patterns(
+            ".git", "__pycache__", "benchmarks", "shared_lists.db*", "requests.jsonl"
+        ),
+    )
+    fixtureFolder = os.path.join(target, "routes", "_bench")
+    os.makedirs(fixtureFolder)
+    for name, source in FIXTURES.items():
+        with open(os.path.join(fixtureFolder, name), "w") as file:
+            file.write(source)
+
+
+class InProcessClient:
+    """Sends requests straight into the Flask app with its test client."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path):
+        response = self.client.get(path)
+        response.get_data()
+        response.close()
+        return response.status_code
+
+
+class HttpClient:
+    """Sends requests over one keep-alive connection, reconnecting if it drops."""
+
+    def __init__(self, port):
+        self.port = port
+        self.connection = None
+
+    def get(self, path):
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+            try:
+                self.connection.request("GET", path)
+                response = self.connection.getresponse()
+                response.read()
+                return response.status
+            except (http.client.HTTPException, OSError):
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def runLoad(clients, path, expected, duration, warmup):
+    """Hit path from one thread per client for duration seconds, after a warmup."""
+    start = time.perf_counter() + warmup
+    deadline = start + duration
+    latencies = [[] for _ in clients]
+    errors = [0] * len(clients)
+
+    def worker(index):
+        client = clients[index]
+        own = latencies[index]
+        while True:
+            before = time.perf_counter()
+            if before >= deadline:
+                return
+            try:
+                ok = client.get(path) == expected
+            except Exception:
+                ok = False
+            after = time.perf_counter()
+            if before >= start:
+                own.append(after - before)
+                if not ok:
+                    errors[index] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(clients))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    allLatencies = sorted(latency for own in latencies for latency in own)
+    count = len(allLatencies)
+    return {
+        "requests": count,
+        "errors": sum(errors),
+        "throughput": count / duration,
+        "p50_ms": percentile(allLatencies, 0.5) * 1000 if count else None,
+        "p99_ms": percentile(allLatencies, 0.99) * 1000 if count else None,
+    }
+
+
+def waitForPort(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("waitress exited before it started listening")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("waitress didn't start listening in time")
+
+
+def freePort():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def benchmarkMode(mode, tree, args, scenarios, levels):
+    """Run every scenario at every concurrency level against one server."""
+    process = None
+    if mode == "inprocess":
+        os.chdir(tree)
+        sys.path.insert(0, tree)
+        import main
+
+        makeClient = lambda: InProcessClient(main.app)  # noqa: E731
+    else:
+        port = freePort()
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "waitress",
+                f"--listen=127.0.0.1:{port}",
+                f"--threads={args.threads}",
+                "main:app",
+            ],
+            cwd=tree,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        waitForPort(port, process)
+        makeClient = lambda: HttpClient(port)  # noqa: E731
+
+    results = {}
+    try:
+        for name in scenarios:
+            path, expected = SCENARIOS[name]
+            results[name] = {}
+            for level in levels:
+                clients = [makeClient() for _ in range(level)]
+                result = runLoad(clients, path, expected, args.duration, args.warmup)
+                results[name][str(level)] = result
+                print(
+                    f"{mode:10} {name:9} c={level:<3} {result['throughput']:9.1f} req/s"
+                    f"  p50 {result['p50_ms'] or 0:8.2f} ms  p99 {result['p99_ms'] or 0:8.2f} ms"
+                    + (f"  errors {result['errors']}" if result["errors"] else "")
+                )
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    return results
+
+
+def compareResults(results, previous):
+    print(f"\nCompared with {previous['commit']} (throughput ratio, >1 is faster):")
+    for mode, scenarios in results["results"].items():
+        for name, levels in scenarios.items():
+            for level, result in levels.items():
+                try:
+                    old = previous["results"][mode][name][level]["throughput"]
+                except KeyError:
+                    continue
+                if old:
+                    print(f"{mode:10} {name:9} c={level:<3} {result['throughput'] / old:6.2f}x")
+
+
+def runBenchmark():
+    args = parseArgs()
+    modes = [mode for mode in args.modes.split(",") if mode]
+    scenarios = [name for name in args.scenarios.split(",") if name]
+    levels = [int(level) for level in args.concurrency.split(",")]
+    for name in scenarios:
+        if name not in SCENARIOS:
+            sys.exit(f"Unknown scenario {name!r}, pick from {', '.join(SCENARIOS)}")
+
+    commit = gitCommit()
+    output = args.output or os.path.join(ROOT, "benchmarks", "results", f"pipeline-{commit}.json")
+    results = {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "settings": {
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "threads": args.threads,
+            "concurrency": levels,
+        },
+        "results": {},
+    }
+
+    temporary = tempfile.mkdtemp(prefix="luaflask-bench-")
+    try:
+        # Waitress runs first, since in-process mode imports main into this process
+        for mode in sorted(modes, key=lambda mode: mode == "inprocess"):
+            tree = os.path.join(temporary, mode)
+            copyTree(tree)
+            results["results"][mode] = benchmarkMode(mode, tree, args, scenarios, levels)
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(temporary, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"\nSaved results to {output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            compareResults(results, json.load(file))
+
+
+if __name__ == "__main__":
+    runBenchmark()
@@ -0,0 +1,215 @@
+--
+-- builder.lua
+--
+-- The HTML builder returned by api.html.builder(). It has the same methods as
+-- the Python HtmlBuilder (still available as api.html.legacyBuilder()), but
+-- builds the page in a Lua table and joins it with table.concat, so building a
+-- page never has to call into Python. Text and attribute values are escaped,
+-- use raw() for HTML that should be written as it is.
+--
+
+local concat, find, gsub, pairs, setmetatable, tostring =
+    table.concat, string.find, string.gsub, pairs, setmetatable, tostring
+
+local Builder = {}
+Builder.__index = Builder
+
+-------------------------------------------------------------------------------
+-- Escaping
+-------------------------------------------------------------------------------
+
+local escapes = {
+  ["&"] = "&amp;",
+  ["<"] = "&lt;",
+  [">"] = "&gt;",
+  ['"'] = "&quot;",
+  ["'"] = "&#39;",
+}
+
+local function escape(value)
+  value = tostring(value)
+  -- Most text has nothing to escape, so skip the gsub when we can
+  if find(value, "[&<>\"']") then
+    return (gsub(value, "[&<>\"']", escapes))
+  end
+  return value
+end
+
+local function formatAttributes(attributes)
+  if not attributes then
+    return ""
+  end
+  local parts, n = {}, 0
+  for key, value in pairs(attributes) do
+    n = n + 1
+    parts[n] = " " .. key .. '="' .. escape(value) .. '"'
+  end
+  return concat(parts)
+end
+
+local function withAttribute(attributes, key, value)
+  attributes = attributes or {}
+  attributes[key] = value
+  return attributes
+end
+
+-------------------------------------------------------------------------------
+-- Building
+-------------------------------------------------------------------------------
+
+function Builder.new()
+  return setmetatable({
+    buffer = {},
+    size = 0,
+    stack = {},
+    depth = 0,
+    chunkSize = 0,
+    pending = 0,
+  }, Builder)
+end
+
+function Builder:raw(html)
+  html = tostring(html)
+  local size = self.size + 1
+  self.buffer[size] = html
+  self.size = size
+  self.pending = self.pending + #html
+  return self
+end
+
+function Builder:plain(text)
+  return self:raw(escape(text))
+end
+
+function Builder:doctype()
+  return self:raw("<!DOCTYPE html>")
+end
+
+function Builder:standalone(tag, attributes)
+  return self:raw("<" .. tag .. formatAttributes(attributes) .. ">")
+end
+
+function Builder:open(tag, attributes)
+  local depth = self.depth + 1
+  self.stack[depth] = tag
+  self.depth = depth
+  return self:raw("<" .. tag .. formatAttributes(attributes) .. ">")
+end
+
+function Builder:selfClosing(tag, attributes)
+  return self:raw("<" .. tag .. formatAttributes(attributes) .. " />")
+end
+
+function Builder:empty(tag, attributes)
+  return self:raw("<" .. tag .. formatAttributes(attributes) .. "></" .. tag .. ">")
+end
+
+function Builder:close(times)
+  for _ = 1, times or 1 do
+    local depth = self.depth
+    if depth == 0 then
+      break
+    end
+    local tag = self.stack[depth]
+    self.stack[depth] = nil
+    self.depth = depth - 1
+    self:raw("</" .. tag .. ">")
+  end
+  return self
+end
+
+function Builder:finish()
+  self:close(self.depth)
+  return concat(self.buffer, "", 1, self.size)
+end
+
+-- Streaming: hand out the HTML built so far instead of keeping it all
+function Builder:stream(chunkSize)
+  self.chunkSize = chunkSize or 8192
+  return self
+end
+
+function Builder:flush(force)
+  if not force and self.pending < self.chunkSize then
+    return ""
+  end
+  local chunk = concat(self.buffer, "", 1, self.size)
+  self.buffer, self.size, self.pending = {}, 0, 0
+  return chunk
+end
+
+-------------------------------------------------------------------------------
+-- Elements
+-------------------------------------------------------------------------------
+
+function Builder:title(text)
+  return self:raw("<title>" .. escape(text) .. "</title>")
+end
+
+function Builder:br()
+  return self:raw("<br>")
+end
+
+function Builder:meta(attributes)
+  return self:selfClosing("meta", attributes)
+end
+
+function Builder:link(attributes)
+  return self:selfClosing("link", attributes)
+end
+
+function Builder:script(src, attributes)
+  return self:standalone("script", withAttribute(attributes, "src", src))
+end
+
+function Builder:scriptInline(code)
+  return self:raw("<script>" .. tostring(code) .. "</script>")
+end
+
+function Builder:style(css)
+  return self:raw("<style>" .. tostring(css) .. "</style>")
+end
+
+function Builder:a(href, attributes)
+  return self:open("a", withAttribute(attributes, "href", href))
+end
+
+function Builder:img(src, attributes)
+  return self:selfClosing("img", withAttribute(attributes, "src", src))
+end
+
+function Builder:input(attributes)
+  return self:selfClosing("input", attributes)
+end
+
+function Builder:button(text, attributes)
+  return self:open("button", attributes):plain(text):close()
+end
+
+function Builder:textarea(attributes)
+  return self:open("textarea", attributes):close()
+end
+
+function Builder:option(value, text, attributes)
+  return self:open("option", withAttribute(attributes, "value", value)):plain(text):close()
+end
+
+-- Tags that just open, e.g. builder:div({class = "row"})
+for _, tag in ipairs({
+  "head", "body", "div", "span", "p", "ul", "ol", "li", "form", "select",
+  "footer", "header", "section", "article", "aside", "main", "nav",
+}) do
+  Builder[tag] = function(self, attributes)
+    return self:open(tag, attributes)
+  end
+end
+
+-- Headings take their text and close straight away, e.g. builder:h1("Title")
+for level = 1, 6 do
+  local tag = "h" .. level
+  Builder[tag] = function(self, text, attributes)
+    return self:open(tag, attributes):plain(text):close()
+  end
+end
+
+return Builder
@@ -1,12 +1,20 @@
-from flask import Flask, request, Response, redirect, g
-from lupa import LuaRuntime
-from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, Response, redirect, g, copy_current_request_context
+from werkzeug.security import safe_join
+from werkzeug.wsgi import wrap_file
+from concurrent.futures import ThreadPoolExecutor, Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
 import requests
+from requests.adapters import HTTPAdapter
 import time
 import mimetypes
 import os
+import posixpath
+import stat
 import json
+import tempfile
+import math
 import hashlib
+import gzip
 import re
 import base64
 import uuid
@@ -18,73 +26,642 @@ import socket
 import psutil
 import dns.resolver
 import urllib.parse
+import threading
+import queue
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial, lru_cache
+from bisect import bisect_left
 
-app = Flask(__name__)
+try:
+    # Pin Lua 5.4 where lupa ships several versions (2.8 defaults to 5.5).
+    # lupa caches the Lua wrappers of Python objects by address, and when an
+    # old wrapper is finalized after the same object was handed to Lua again,
+    # it drops the reference keeping the object alive, so Lua can end up
+    # calling a freed object. 5.5 runs finalizers late enough to hit this far
+    # more often than 5.4, which narrows the window but doesn't close it.
+    # Objects that stay referenced from Python (like the api functions) are
+    # safe either way
+    from lupa.lua54 import LuaRuntime, LuaMemoryError, lua_type
+except ImportError:
+    from lupa import LuaRuntime, LuaMemoryError, lua_type
+
+try:
+    # Optional: lets the route cache drop entries as soon as a file changes
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+try:
+    # Optional: faster JSON for api.json
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # Optional: brotli compression for responses, next to gzip
+    import brotli
+except ImportError:
+    brotli = None
+
+# The built-in static route is replaced by serveStatic below
+app = Flask(__name__, static_folder=None)
 app.config["ROUTES_FOLDER"] = "routes"
+app.config["STATIC_FOLDER"] = "static"
+app.config["STATIC_MAX_AGE"] = None  # Cache-Control max-age for files (None = always revalidate)
+app.config["STATIC_STAT_TTL"] = 1  # Seconds a file's stat result is reused
+app.config["STATIC_PRECOMPRESS"] = False  # Write .gz/.br copies of static files at startup
+app.config["COMPRESS_MIN_SIZE"] = 500  # Smallest body in bytes worth compressing (None = never compress)
+app.config["COMPRESS_TYPES"] = (  # Content types that get compressed
+    "text/html",
+    "text/css",
+    "text/plain",
+    "text/javascript",
+    "text/xml",
+    "application/javascript",
+    "application/json",
+    "application/xml",
+    "image/svg+xml",
+)
+app.config["COMPRESS_GZIP_LEVEL"] = 6  # 1 (fastest) to 9 (smallest)
+app.config["COMPRESS_BROTLI_QUALITY"] = 5  # 0 (fastest) to 11 (smallest)
+app.config["HTTP_TIMEOUT"] = 10  # Default timeout in seconds for api.http requests
+app.config["HTTP_POOL_HOSTS"] = 32  # Hosts api.http keeps connection pools for
+app.config["HTTP_POOL_PER_HOST"] = 10  # Max connections open to a single host
+app.config["HTTP_BATCH_WORKERS"] = 32  # Threads shared by api.http.batch calls
+app.config["ASGI_WSGI_THREADS"] = 16  # Threads asgi.py hands non-Lua requests to Flask on
 app.config["MODULES_FOLDER"] = "modules"
+app.config["MODULE_CACHE_FOLDER"] = ".luacache"  # Compiled module bytecode (None = don't cache)
 app.config["ERRORS_FOLDER"] = os.path.join(app.config["ROUTES_FOLDER"], "errors")
-lua = LuaRuntime(unpack_returned_tuples=True)
+app.config["ROUTE_CACHE_SIZE"] = 1024  # Max compiled routes kept in memory
+app.config["ROUTE_CACHE_WATCH"] = False  # Use a filesystem watcher (needs watchdog)
+app.config["ROUTE_INDEX_POLL"] = 2  # Rescan routes every N seconds when not watching (0 = never)
+app.config["LUA_RUNTIMES"] = min(32, (os.cpu_count() or 1) + 4)  # Size of the runtime pool
+app.config["LUA_RUNTIME_MAX_REQUESTS"] = 1000  # Recycle a runtime after this many requests (0 = never)
+app.config["LUA_RUNTIME_MAX_MEMORY"] = 64 * 1024 * 1024  # Recycle a runtime above this many bytes (0 = never)
+app.config["LUA_MEMORY_LIMIT"] = 256 * 1024 * 1024  # Hard cap on a runtime's memory, going over fails the request (0 = off)
+app.config["LUA_INSTRUCTION_LIMIT"] = 1_000_000_000  # Max Lua instructions per request (0 = off)
+app.config["LUA_TIMEOUT"] = 30  # Seconds a Lua route may run (0 = off)
+app.config["LUA_ROUTE_TIMEOUTS"] = {}  # Per-route overrides, e.g. {"reports/export": 120}
+app.config["MAX_IN_FLIGHT"] = app.config["LUA_RUNTIMES"]  # Lua requests running at once (0 = no limit)
+app.config["MAX_QUEUED"] = 64  # Lua requests waiting for a slot, more get a 503 straight away
+app.config["QUEUE_TIMEOUT"] = 10  # Seconds a request waits for a slot before it gets a 503
+app.config["ROUTE_CONCURRENCY"] = {}  # Per-route max Lua requests at once, e.g. {"reports/export": 2}
+app.config["OVERLOAD_RETRY_AFTER"] = 5  # Retry-After seconds sent with an overload 503
+app.config["RESPONSE_CACHE_SIZE"] = 1024  # Max cached Lua responses kept in memory (0 = off)
+app.config["RESPONSE_CACHE_DB"] = None  # SQLite file for a second cache tier shared by processes (None = off)
+app.config["CACHE_BACKEND"] = "memory"  # api.cache store: "memory" (per process) or "shared" (across workers)
+app.config["CACHE_SIZE"] = 10000  # Max keys in api.cache, least recently used ones are dropped first
+app.config["CACHE_SHARED_PATH"] = os.path.join(  # File for the shared backend, in RAM where possible
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+    "luaflask_cache.db",
+)
+app.config["METRICS_PATH"] = "/metrics"  # Prometheus metrics endpoint (None = off)
+app.config["PROFILING_ENABLED"] = False  # Allow profiling Lua routes (exposes source paths at PROFILE_PATH)
+app.config["PROFILING_SAMPLE_RATE"] = 0  # Fraction of Lua requests profiled without being asked, e.g. 0.01
+app.config["PROFILE_PATH"] = "/_profile"  # Where the collected profiles are served
 executor = ThreadPoolExecutor()
+# Runs <$lua async> blocks. Every job holds a runtime, so it never needs more
+# threads than there are runtimes
+fragmentExecutor = ThreadPoolExecutor(app.config["LUA_RUNTIMES"])
 
 showLuaErrors = False
 
 
+# Histogram buckets for latencies, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def formatLabels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Metrics:
+    """Counters, histograms and gauges rendered in the Prometheus text format.
+
+    Gauges (and counters owned by other objects) are read through a collect
+    function when the metrics are scraped, instead of being updated on every
+    request.
+    """
+
+    def __init__(self, enabled=True, buckets=LATENCY_BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.families = {}  # name -> (type, help, collect or None)
+        self.values = {}  # name -> {labels: number, or [bucket counts, sum, count]}
+
+    def counter(self, name, help, collect=None):
+        self.families[name] = ("counter", help, collect)
+        self.values[name] = {}
+
+    def histogram(self, name, help):
+        self.families[name] = ("histogram", help, None)
+        self.values[name] = {}
+
+    def gauge(self, name, help, collect):
+        self.families[name] = ("gauge", help, collect)
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self.values[name]
+            values[key] = values.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values[name].get(key)
+            if series is None:
+                series = self.values[name][key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = []
+        for name, (kind, help, collect) in self.families.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if collect is not None:
+                samples = {tuple(sorted(labels.items())): value for labels, value in collect()}
+            else:
+                with self.lock:
+                    samples = {
+                        key: [list(value[0]), value[1], value[2]] if kind == "histogram" else value
+                        for key, value in self.values[name].items()
+                    }
+
+            for labels, value in samples.items():
+                if kind != "histogram":
+                    lines.append(f"{name}{formatLabels(labels)} {value}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucketCount in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += bucketCount
+                    lines.append(
+                        f"{name}_bucket{formatLabels(labels + (('le', bound),))} {cumulative}"
+                    )
+                lines.append(f"{name}_sum{formatLabels(labels)} {total}")
+                lines.append(f"{name}_count{formatLabels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(enabled=bool(app.config["METRICS_PATH"]))
+metrics.counter("luaflask_requests_total", "Requests handled, by route and status code.")
+metrics.histogram(
+    "luaflask_request_duration_seconds", "Time to produce a response, by route."
+)
+metrics.histogram(
+    "luaflask_route_stage_seconds",
+    "Time spent per stage of a request: lookup, compile, execute and build.",
+)
+metrics.histogram("luaflask_sqlite_seconds", "Time spent in SQLite, by database and operation.")
+metrics.counter(
+    "luaflask_response_cache_total", "Response cache lookups by result: hit, stale or miss."
+)
+
+
+class QueueDepth:
+    """Counts jobs handed to an executor that haven't started running yet."""
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def add(self, amount):
+        with self.lock:
+            self.value += amount
+
+    def submit(self, executor, function, *args):
+        self.add(1)
+
+        def run():
+            self.add(-1)
+            return function(*args)
+
+        return executor.submit(run)
+
+
+executorQueue = QueueDepth()
+metrics.gauge(
+    "luaflask_executor_queue_depth",
+    "Lua requests waiting for an executor thread.",
+    lambda: [({}, executorQueue.value)],
+)
+
+
+class AdmissionControl:
+    """Caps how many Lua requests run at once, overall and per route.
+
+    Requests over the cap wait in a bounded queue. Once the queue is full, or
+    a request has waited too long, acquire fails so it can be turned away
+    quickly instead of piling up behind slow routes.
+    """
+
+    def __init__(self, maxInFlight, maxQueued, queueTimeout):
+        self.maxInFlight = maxInFlight
+        self.maxQueued = maxQueued
+        self.queueTimeout = queueTimeout
+        self.condition = threading.Condition()
+        self.inFlight = 0
+        self.queued = 0
+        self.routeInFlight = {}  # route file -> requests running
+        self.declared = {}  # route file -> concurrency its route file asked for
+
+    def declare(self, path, concurrency):
+        """Remember the concurrency a route file declared (None for no limit)."""
+        if concurrency:
+            self.declared[path] = int(concurrency)
+        else:
+            self.declared.pop(path, None)
+
+    def hasRoom(self, path, limit):
+        if self.maxInFlight and self.inFlight >= self.maxInFlight:
+            return False
+        return not limit or self.routeInFlight.get(path, 0) < limit
+
+    def acquire(self, path, limit):
+        """Take a slot for a request to path, waiting in the queue if needed.
+
+        Returns None once it has a slot, or why it was turned away: "full"
+        when the queue is full, "timeout" when it waited too long.
+        """
+        with self.condition:
+            if not self.hasRoom(path, limit):
+                if self.queued >= self.maxQueued:
+                    return "full"
+                deadline = time.monotonic() + self.queueTimeout
+                self.queued += 1
+                try:
+                    while not self.hasRoom(path, limit):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return "timeout"
+                        self.condition.wait(remaining)
+                finally:
+                    self.queued -= 1
+            self.inFlight += 1
+            self.routeInFlight[path] = self.routeInFlight.get(path, 0) + 1
+        return None
+
+    def releaser(self, path):
+        """A function that gives back path's slot, however many times it is called."""
+        once = threading.Lock()
+
+        def release():
+            if once.acquire(blocking=False):
+                self.release(path)
+
+        return release
+
+    def release(self, path):
+        with self.condition:
+            self.inFlight -= 1
+            count = self.routeInFlight[path] - 1
+            if count:
+                self.routeInFlight[path] = count
+            else:
+                del self.routeInFlight[path]
+            # Waiters may be held by different limits, so wake them all to check
+            self.condition.notify_all()
+
+
+admission = AdmissionControl(
+    app.config["MAX_IN_FLIGHT"], app.config["MAX_QUEUED"], app.config["QUEUE_TIMEOUT"]
+)
+metrics.histogram(
+    "luaflask_queue_wait_seconds", "Time Lua requests waited for a slot, by route."
+)
+metrics.counter(
+    "luaflask_requests_shed_total",
+    "Lua requests turned away with a 503, by route and reason: full or timeout.",
+)
+metrics.gauge(
+    "luaflask_requests_in_flight",
+    "Lua requests running.",
+    lambda: [({}, admission.inFlight)],
+)
+metrics.gauge(
+    "luaflask_requests_queued",
+    "Lua requests waiting for a slot.",
+    lambda: [({}, admission.queued)],
+)
+
+
+class CpuSampler:
+    """Samples CPU usage in a background thread so reading it never blocks."""
+
+    def __init__(self, interval=1):
+        self.interval = interval
+        self.value = 0.0
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            # Start on first use, and again in a forked worker (threads don't survive a fork)
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                threading.Thread(target=self.run, daemon=True).start()
+        return self.value
+
+    def run(self):
+        while True:
+            self.value = psutil.cpu_percent(interval=self.interval)
+
+
+cpuSampler = CpuSampler()
+
+
+class Profiler:
+    """Time per Lua stack from profiled requests, summed as collapsed stacks."""
+
+    def __init__(self, maxStacks=10000):
+        self.maxStacks = maxStacks
+        self.stacks = {}  # "route;frame;frame" -> seconds
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def add(self, route, samples):
+        with self.lock:
+            self.requests += 1
+            for stack, seconds in samples:
+                key = f"{route};{stack}"
+                if key not in self.stacks and len(self.stacks) >= self.maxStacks:
+                    key = f"{route};(other)"
+                self.stacks[key] = self.stacks.get(key, 0) + seconds
+
+    def collapsed(self, route=None):
+        """One "stack microseconds" line per stack, the format flamegraph tools read."""
+        with self.lock:
+            stacks = list(self.stacks.items())
+        lines = []
+        for stack, seconds in sorted(stacks):
+            microseconds = round(seconds * 1000000)
+            if microseconds > 0 and (route is None or stack.startswith(route + ";")):
+                lines.append(f"{stack} {microseconds}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def reset(self):
+        with self.lock:
+            self.stacks.clear()
+            self.requests = 0
+
+
+profiler = Profiler()
+
+
+def profileRequested():
+    """Whether this request asked to be profiled, with the header or query parameter."""
+    return request.headers.get("X-LuaFlask-Profile") == "1" or "_profile" in request.args
+
+
+def shouldProfile():
+    """Profile this request if profiling is on and it asked for it or was sampled."""
+    if not app.config["PROFILING_ENABLED"]:
+        return False
+    return profileRequested() or random.random() < app.config["PROFILING_SAMPLE_RATE"]
+
+
 DATABASE = "shared_lists.db"
+app.config["DATABASE_PERSIST"] = False  # Keep shared lists across restarts
+app.config["DATABASE_SYNCHRONOUS"] = "NORMAL"  # SQLite synchronous level: OFF, NORMAL or FULL
+app.config["DATABASE_COMMIT_WINDOW"] = 0  # Seconds to group writes into one commit (0 = off)
 
 
-try:
-    os.remove(DATABASE)
-except Exception:
-    pass
+@contextmanager
+def transaction(connection):
+    """Run the block in a write transaction, rolling back if it raises."""
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield connection
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+
+class GroupCommitter:
+    """Runs writes from many threads on one connection, committing them in batches.
+
+    Each write waits until the batch it landed in is committed, so a request
+    still only returns once its data is durable, but concurrent requests share
+    one fsync instead of paying for one each.
+    """
+
+    def __init__(self, database, window):
+        self.database = database
+        self.window = window
+        self.jobs = queue.Queue()
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def submit(self, work):
+        with self.lock:
+            # Start on first use, so importing main doesn't start a thread
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                threading.Thread(target=self.run, daemon=True).start()
+        future = Future()
+        self.jobs.put((work, future))
+        return future.result()
+
+    def run(self):
+        connection = self.database.connect()
+        while True:
+            batch = [self.jobs.get()]
+            deadline = time.monotonic() + self.window
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    batch.append(self.jobs.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            results = []
+            try:
+                with transaction(connection):
+                    for work, future in batch:
+                        # A savepoint per write so one failure doesn't undo the rest
+                        connection.execute("SAVEPOINT job")
+                        try:
+                            results.append((future, work(connection), None))
+                            connection.execute("RELEASE job")
+                        except Exception as e:
+                            connection.execute("ROLLBACK TO job")
+                            connection.execute("RELEASE job")
+                            results.append((future, None, e))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for future, result, error in results:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+
+class Database:
+    """Per-thread SQLite connections in WAL mode, so reads never wait on writes."""
+
+    def __init__(self, path, synchronous="NORMAL", commitWindow=0, mmapSize=0):
+        self.path = path
+        self.synchronous = synchronous
+        self.commitWindow = commitWindow
+        self.mmapSize = mmapSize
+        self.name = os.path.basename(path)
+        self.reset()
+
+    def reset(self):
+        """Drop every connection, e.g. after forking into a worker process."""
+        self.local = threading.local()
+        self.committer = None
+        if self.commitWindow:
+            self.committer = GroupCommitter(self, self.commitWindow)
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(f"PRAGMA synchronous={self.synchronous}")
+        if self.mmapSize:
+            connection.execute(f"PRAGMA mmap_size={self.mmapSize}")
+        return connection
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = self.connect()
+        return connection
+
+    def execute(self, sql, parameters=()):
+        """Run a read on this thread's connection."""
+        with metrics.timer("luaflask_sqlite_seconds", database=self.name, operation="read"):
+            return self.connection().execute(sql, parameters)
+
+    def write(self, work):
+        """Run work(connection) in a transaction and return its result once committed."""
+        with metrics.timer("luaflask_sqlite_seconds", database=self.name, operation="write"):
+            if self.committer is not None:
+                return self.committer.submit(work)
+            connection = self.connection()
+            with transaction(connection):
+                return work(connection)
+
+
+if not app.config["DATABASE_PERSIST"]:
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(DATABASE + suffix)
+        except Exception:
+            pass
 
-# Initialize the database connection as a global variable
-db = sqlite3.connect(DATABASE)
+database = Database(
+    DATABASE,
+    app.config["DATABASE_SYNCHRONOUS"],
+    app.config["DATABASE_COMMIT_WINDOW"],
+)
 
 
 # Database Initialization to run on app start
 def initDb():
-    cursor = db.cursor()
-    cursor.execute(
-        """CREATE TABLE IF NOT EXISTS SharedList (
-                        id TEXT PRIMARY KEY,
-                        data TEXT NOT NULL
-                    )"""
-    )
-    db.commit()
+    connection = database.connection()
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(SharedList)")]
+    if "data" in columns:
+        migrateJsonLists(connection)
+    with transaction(connection):
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS SharedList (
+                            id TEXT PRIMARY KEY
+                        )"""
+        )
+        # One row per item, positions run 1..n within a list (Lua indexing)
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS SharedListItem (
+                            list_id TEXT NOT NULL,
+                            position INTEGER NOT NULL,
+                            value TEXT NOT NULL
+                        )"""
+        )
+        connection.execute(
+            """CREATE INDEX IF NOT EXISTS SharedListItemPosition
+                        ON SharedListItem (list_id, position)"""
+        )
     print("Database initialized.")
 
-# Ensure initDb runs when the script starts
-initDb()
 
-
-# Shared List Operations
-def getList(listId):
-    cursor = db.cursor()
-    cursor.execute("SELECT data FROM SharedList WHERE id = ?", (listId,))
-    row = cursor.fetchone()
-    if row:
-        return json.loads(row[0])  # Deserialize JSON data
-    else:
-        # Insert a new empty list if not found
-        cursor.execute(
-            "INSERT INTO SharedList (id, data) VALUES (?, ?)", (listId, json.dumps([]))
+def migrateJsonLists(connection):
+    """Move lists from the old one-JSON-blob-per-list table to one row per item."""
+    with transaction(connection):
+        connection.execute("ALTER TABLE SharedList RENAME TO SharedListJson")
+        connection.execute("CREATE TABLE SharedList (id TEXT PRIMARY KEY)")
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS SharedListItem (
+                            list_id TEXT NOT NULL,
+                            position INTEGER NOT NULL,
+                            value TEXT NOT NULL
+                        )"""
         )
-        db.commit()
-        return []
+        for listId, data in connection.execute(
+            "SELECT id, data FROM SharedListJson"
+        ).fetchall():
+            connection.execute("INSERT INTO SharedList (id) VALUES (?)", (listId,))
+            connection.executemany(
+                "INSERT INTO SharedListItem (list_id, position, value) VALUES (?, ?, ?)",
+                [
+                    (listId, position, str(value))
+                    for position, value in enumerate(json.loads(data), start=1)
+                ],
+            )
+        connection.execute("DROP TABLE SharedListJson")
+    print("Migrated shared lists to the per-item table.")
 
+# Ensure initDb runs when the script starts
+initDb()
 
-def updateList(listId, data):
-    cursor = db.cursor()
-    cursor.execute(
-        "UPDATE SharedList SET data = ? WHERE id = ?", (json.dumps(data), listId)
-    )
-    db.commit()
+
+def toPosition(index):
+    """Turn a Lua index into an int, or None if it isn't a whole number."""
+    try:
+        position = int(index)
+    except (TypeError, ValueError):
+        return None
+    return position if position == index else None
 
 
 class HtmlBuilder:
     def __init__(self):
         self.html_content = []
         self.tag_stack = []
+        self.chunk_size = 0
+        self.pending_size = 0
+
+    def _append(self, text):
+        text = str(text)
+        self.html_content.append(text)
+        self.pending_size += len(text)
 
     def _format_attributes(self, attributes):
         if not attributes:
@@ -92,40 +669,40 @@ class HtmlBuilder:
         return " " + " ".join(f'{k}="{v}"' for k, v in attributes.items())
 
     def doctype(self):
-        self.html_content.append("<!DOCTYPE html>")
+        self._append("<!DOCTYPE html>")
         return self
 
     def standalone(self, tag, attributes=None):
         formatted_attributes = self._format_attributes(attributes)
-        self.html_content.append(f"<{tag}{formatted_attributes}>")
+        self._append(f"<{tag}{formatted_attributes}>")
         return self
 
     def open(self, tag, attributes=None):
         formatted_attributes = self._format_attributes(attributes)
-        self.html_content.append(f"<{tag}{formatted_attributes}>")
+        self._append(f"<{tag}{formatted_attributes}>")
         self.tag_stack.append(tag)
         return self
 
     def selfClosing(self, tag, attributes=None):
         formatted_attributes = self._format_attributes(attributes)
-        self.html_content.append(f"<{tag}{formatted_attributes} />")
+        self._append(f"<{tag}{formatted_attributes} />")
         return self
 
     def empty(self, tag, attributes=None):
         formatted_attributes = self._format_attributes(attributes)
-        self.html_content.append(f"<{tag}{formatted_attributes}></{tag}>")
+        self._append(f"<{tag}{formatted_attributes}></{tag}>")
         return self
 
     def plain(self, text):
-        self.html_content.append(text)
+        self._append(text)
         return self
 
     def title(self, text):
-        self.html_content.append(f"<title>{text}</title>")
+        self._append(f"<title>{text}</title>")
         return self
 
     def br(self):
-        self.html_content.append("<br>")
+        self._append("<br>")
         return self
 
     def head(self):
@@ -150,7 +727,7 @@ class HtmlBuilder:
         for _ in range(times):
             if self.tag_stack:
                 tag = self.tag_stack.pop()
-                self.html_content.append(f"</{tag}>")
+                self._append(f"</{tag}>")
         return self
 
     def finish(self):
@@ -158,6 +735,20 @@ class HtmlBuilder:
             self.close()
         return "".join(self.html_content)
 
+    # Streaming: hand out the HTML built so far instead of keeping it all
+    def stream(self, chunkSize=8192):
+        self.chunk_size = chunkSize
+        return self
+
+    def flush(self, force=False):
+        """Return and clear the pending HTML once it reaches the chunk size, else ""."""
+        if not force and self.pending_size < self.chunk_size:
+            return ""
+        chunk = "".join(self.html_content)
+        self.html_content = []
+        self.pending_size = 0
+        return chunk
+
     # New Methods for Additional HTML Elements
     def div(self, attributes=None):
         return self.open("div", attributes)
@@ -250,18 +841,18 @@ class HtmlBuilder:
         return self.open("nav", attributes)
 
     def scriptInline(self, code):
-        self.html_content.append(f"<script>{code}</script>")
+        self._append(f"<script>{code}</script>")
         return self
 
     def style(self, css):
-        self.html_content.append(f"<style>{css}</style>")
+        self._append(f"<style>{css}</style>")
         return self
 
 
 class OsApi:
     @staticmethod
     def listDir(path):
-        return lua.table_from(os.listdir(path))
+        return currentLua().table_from(os.listdir(path))
 
     @staticmethod
     def remove(path):
@@ -320,26 +911,71 @@ class OsApi:
         return os.path.islink(path)
 
 
+# One session for all outbound requests so connections are kept alive and reused
+httpSession = requests.Session()
+httpAdapter = HTTPAdapter(
+    pool_connections=app.config["HTTP_POOL_HOSTS"],
+    pool_maxsize=app.config["HTTP_POOL_PER_HOST"],
+    pool_block=True,  # Wait for a free connection instead of opening more per host
+)
+httpSession.mount("http://", httpAdapter)
+httpSession.mount("https://", httpAdapter)
+httpExecutor = ThreadPoolExecutor(app.config["HTTP_BATCH_WORKERS"])
+
+
+def sendHttpRequest(method, url, data=None, headers=None, timeout=None):
+    """Send one request on the shared session and return a plain result dict."""
+    try:
+        response = httpSession.request(
+            method,
+            url,
+            data=data,
+            headers=headers,
+            timeout=timeout or app.config["HTTP_TIMEOUT"],
+        )
+        return {"status": response.status_code, "data": response.text}
+    except requests.RequestException as e:
+        return {"status": 500, "data": f"Error: {str(e)}"}
+
+
+def httpRequestArgs(spec):
+    """Read a Lua request table into plain Python arguments for sendHttpRequest."""
+    headers = spec["headers"]
+    data = spec["data"]
+    return (
+        (spec["method"] or "GET").upper(),
+        spec["url"],
+        None if data is None else str(data),
+        dict(headers) if headers else None,
+        spec["timeout"],
+    )
+
+
 class HttpApi:
     @staticmethod
     def get(url, headers=None):
-        try:
-            response = requests.get(url, headers=headers)
-            return lua.table_from(
-                {"status": response.status_code, "data": response.text}
-            )
-        except requests.RequestException as e:
-            return lua.table_from({"status": 500, "data": f"Error: {str(e)}"})
+        result = sendHttpRequest("GET", url, headers=dict(headers) if headers else None)
+        return currentLua().table_from(result)
 
     @staticmethod
     def post(url, data=None, headers=None):
-        try:
-            response = requests.post(url, data=str(data), headers=headers)
-            return lua.table_from(
-                {"status": response.status_code, "data": response.text}
-            )
-        except requests.RequestException as e:
-            return lua.table_from({"status": 500, "data": f"Error: {str(e)}"})
+        result = sendHttpRequest(
+            "POST",
+            url,
+            data=None if data is None else str(data),
+            headers=dict(headers) if headers else None,
+        )
+        return currentLua().table_from(result)
+
+    @staticmethod
+    def batch(specs):
+        """Send several requests at once and return their results in the same order."""
+        # Lua objects can't be touched from other threads, so convert them first.
+        # Walk 1..n rather than values(), whose order isn't defined
+        requestArgs = [httpRequestArgs(specs[index]) for index in range(1, len(specs) + 1)]
+        futures = [httpExecutor.submit(sendHttpRequest, *args) for args in requestArgs]
+        lua = currentLua()
+        return lua.table_from([lua.table_from(future.result()) for future in futures])
 
 
 class HtmlApi:
@@ -349,32 +985,27 @@ class HtmlApi:
 
     @staticmethod
     def serveError(code):
-        try:
-            # Try serving the requested error code file
-            with open(
-                os.path.join(app.config["ERRORS_FOLDER"], f"{code}.html"), "r"
-            ) as file:
-                error = file.read()
-                return {"response": error, "type": "text/html", "code": code}
-        except FileNotFoundError:
-            try:
-                # Fallback to 500.html if the specific error file doesn't exist
-                with open(
-                    os.path.join(app.config["ERRORS_FOLDER"], "500.html"), "r"
-                ) as file:
-                    error = file.read()
-                    return {"response": error, "type": "text/html", "code": 500}
-            except FileNotFoundError:
-                # Final fallback to plain text response
-                return {
-                    "response": "Hi, the person who made this website is a terrible person, and didn't even bother to make an error page.\nThis is the default error message on the server software made by a good person.\nLike they literally asked the software to return an error, but they didn't even make the page for that error, or the default error page.\nThe code was: 500",
-                    "type": "text/plain",
-                    "code": 500,
-                }
+        # Try serving the requested error code page
+        error = errorPages.get(code)
+        if error is not None:
+            return {"response": error, "type": "text/html", "code": code}
+
+        # Fallback to 500.html if the specific error page doesn't exist
+        error = errorPages.get(500)
+        if error is not None:
+            return {"response": error, "type": "text/html", "code": 500}
+
+        # Final fallback to plain text response
+        return {
+            "response": "Hi, the person who made this website is a terrible person, and didn't even bother to make an error page.\nThis is the default error message on the server software made by a good person.\nLike they literally asked the software to return an error, but they didn't even make the page for that error, or the default error page.\nThe code was: 500",
+            "type": "text/plain",
+            "code": 500,
+        }
 
     @staticmethod
-    def builder():
-        return HtmlBuilder()  # Assumes HtmlBuilder class is already defined
+    def legacyBuilder():
+        # api.html.builder() is the Lua version from builder.lua
+        return HtmlBuilder()
 
 
 class UtilityApi:
@@ -385,7 +1016,7 @@ class UtilityApi:
     @staticmethod
     def serveRedirect(link):
         """Return a dictionary for a redirect response."""
-        return lua.table_from({"_redirect": link})
+        return currentLua().table_from({"_redirect": link})
 
     @staticmethod
     def hashData(data, algorithm="sha256"):
@@ -456,7 +1087,7 @@ class UtilityApi:
 
     @staticmethod
     def getCpuUsage():
-        return psutil.cpu_percent(interval=1)
+        return cpuSampler.get()
 
     @staticmethod
     def getMemoryUsage():
@@ -467,195 +1098,2367 @@ class UtilityApi:
 class SharedListApi:
     @staticmethod
     def appendToList(listId, item):
-        dataList = getList(listId)
-        dataList.append(str(item))  # Append to the list (starting at index 1 in Lua)
-        updateList(listId, dataList)
+        def append(connection):
+            connection.execute(
+                "INSERT OR IGNORE INTO SharedList (id) VALUES (?)", (listId,)
+            )
+            # Append to the list (starting at index 1 in Lua)
+            connection.execute(
+                """INSERT INTO SharedListItem (list_id, position, value)
+                    SELECT ?, COALESCE(MAX(position), 0) + 1, ?
+                    FROM SharedListItem WHERE list_id = ?""",
+                (listId, str(item), listId),
+            )
+
+        database.write(append)
         return f"Item added to list {listId}"
 
+    @staticmethod
+    def appendMany(listId, items):
+        """Append every item of a Lua array in one transaction, returns the new length."""
+        values = [str(items[index]) for index in range(1, len(items) + 1)]
+
+        def append(connection):
+            connection.execute(
+                "INSERT OR IGNORE INTO SharedList (id) VALUES (?)", (listId,)
+            )
+            end = connection.execute(
+                "SELECT COALESCE(MAX(position), 0) FROM SharedListItem WHERE list_id = ?",
+                (listId,),
+            ).fetchone()[0]
+            connection.executemany(
+                "INSERT INTO SharedListItem (list_id, position, value) VALUES (?, ?, ?)",
+                [(listId, end + offset, value) for offset, value in enumerate(values, 1)],
+            )
+            return end + len(values)
+
+        return database.write(append)
+
     @staticmethod
     def removeFromList(listId, item):
-        dataList = getList(listId)
-        try:
-            dataList.remove(int(item))
-            updateList(listId, dataList)
-            return f"Item removed from list {listId}"
-        except ValueError:
+        position = toPosition(item)
+
+        def remove(connection):
+            deleted = connection.execute(
+                "DELETE FROM SharedListItem WHERE list_id = ? AND position = ?",
+                (listId, position),
+            ).rowcount
+            if deleted:
+                # Close the gap so positions stay 1..n
+                connection.execute(
+                    """UPDATE SharedListItem SET position = position - 1
+                        WHERE list_id = ? AND position > ?""",
+                    (listId, position),
+                )
+            return deleted
+
+        if not database.write(remove):
             return f"Item not found in list {listId}"
+        return f"Item removed from list {listId}"
 
     @staticmethod
     def getListData(listId):
-        return lua.table_from(getList(listId))
+        rows = database.execute(
+            "SELECT value FROM SharedListItem WHERE list_id = ? ORDER BY position",
+            (listId,),
+        ).fetchall()
+        return currentLua().table_from([row[0] for row in rows])
+
+    @staticmethod
+    def getRange(listId, start, count):
+        """Up to count items starting at position start, as a Lua array."""
+        start, count = toPosition(start), toPosition(count)
+        if start is None or count is None or count < 1:
+            return currentLua().table()
+        rows = database.execute(
+            """SELECT value FROM SharedListItem
+                WHERE list_id = ? AND position BETWEEN ? AND ? ORDER BY position""",
+            (listId, start, start + count - 1),
+        ).fetchall()
+        return currentLua().table_from([row[0] for row in rows])
 
     @staticmethod
     def getItem(listId, index):
-        dataList = getList(listId)
-        # Adjust index to be 1-based (Lua convention)
-        if 0 < index <= len(dataList):
-            return dataList[index - 1]
-        return None
+        # Positions are 1-based (Lua convention)
+        row = database.execute(
+            "SELECT value FROM SharedListItem WHERE list_id = ? AND position = ?",
+            (listId, toPosition(index)),
+        ).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def length(listId):
+        return database.execute(
+            "SELECT COALESCE(MAX(position), 0) FROM SharedListItem WHERE list_id = ?",
+            (listId,),
+        ).fetchone()[0]
+
+    @staticmethod
+    def pop(listId):
+        """Remove the last item of a list and return it (nil if the list is empty)."""
+
+        def pop(connection):
+            row = connection.execute(
+                """SELECT position, value FROM SharedListItem
+                    WHERE list_id = ? ORDER BY position DESC LIMIT 1""",
+                (listId,),
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "DELETE FROM SharedListItem WHERE list_id = ? AND position = ?",
+                (listId, row[0]),
+            )
+            return row[1]
+
+        return database.write(pop)
 
     @staticmethod
     def deleteList(listId):
-        cursor = db.cursor()
-        cursor.execute("DELETE FROM SharedList WHERE id = ?", (listId,))
-        db.commit()
+        def delete(connection):
+            connection.execute("DELETE FROM SharedListItem WHERE list_id = ?", (listId,))
+            connection.execute("DELETE FROM SharedList WHERE id = ?", (listId,))
+
+        database.write(delete)
         return f"List {listId} deleted"
 
     @staticmethod
     def listExists(listId):
-        cursor = db.cursor()
-        cursor.execute("SELECT COUNT(1) FROM SharedList WHERE id = ?", (listId,))
-        exists = cursor.fetchone()[0] > 0
-        return exists
+        row = database.execute(
+            "SELECT 1 FROM SharedList WHERE id = ?", (listId,)
+        ).fetchone()
+        return row is not None
+
+
+JSON_SCALARS = (str, int, bool, type(None))
+# Floats with whole values up to this size are written as integers
+JSON_MAX_EXACT_INTEGER = 2**53
+# Below this depth tables aren't checked for cycles, since that costs a call into Lua
+JSON_CYCLE_CHECK_DEPTH = 64
+
+
+def luaToPython(value, path=None):
+    """Convert a Lua value to something json can encode, with json.lua's rules."""
+    if type(value) in JSON_SCALARS:
+        return value
+    if type(value) is float:
+        if value != value or value in (math.inf, -math.inf):
+            raise ValueError(f"unexpected number value '{value}'")
+        # Lua 5.4 arithmetic often gives floats (10 / 2 is 5.0), json.lua writes them as 5
+        if value.is_integer() and -JSON_MAX_EXACT_INTEGER <= value <= JSON_MAX_EXACT_INTEGER:
+            return int(value)
+        return value
+    if isinstance(value, (dict, list)):
+        return value  # Already Python, e.g. the result of api.html.serveHtml
+    valueType = lua_type(value)
+    if valueType != "table":
+        raise TypeError(f"unexpected type '{valueType}'")
+
+    if path is None:
+        try:
+            return luaToPython(value, [])
+        except RecursionError:
+            raise ValueError("table nested too deeply") from None
+
+    # Lua tables have no stable identity on the Python side, so once nesting
+    # gets deep enough to be a cycle, the tables on the current path are told
+    # apart by their address in the runtime
+    tableId = None
+    if len(path) >= JSON_CYCLE_CHECK_DEPTH:
+        getId = luaContext.state.tableId
+        for entry in path:
+            if entry[1] is None:
+                entry[1] = getId(entry[0])
+        tableId = getId(value)
+        if any(entry[1] == tableId for entry in path):
+            raise ValueError("circular reference")
+    path.append([value, tableId])
+
+    items = list(value.items())
+    # Treat as an array if it has a [1] or is empty, like json.lua
+    isArray = not items or value[1] is not None
+    result = [None] * len(items) if isArray else {}
+    for key, item in items:
+        if isArray:
+            if type(key) is not int:
+                raise ValueError("invalid table: mixed or invalid key types")
+            if not 0 < key <= len(items):
+                raise ValueError("invalid table: sparse array")
+            key -= 1
+        elif type(key) is not str:
+            raise ValueError("invalid table: mixed or invalid key types")
+        # Scalars are by far the most common values, so skip the call for them
+        if type(item) in JSON_SCALARS:
+            result[key] = item
+        else:
+            result[key] = luaToPython(item, path)
+    path.pop()
+    return result
+
+
+class JsonApi:
+    """api.json, backed by Python's C json module (or orjson when installed)."""
+
+    @staticmethod
+    def encode(value):
+        data = luaToPython(value)
+        if orjson is not None:
+            try:
+                return orjson.dumps(data).decode("utf-8")
+            except orjson.JSONEncodeError:
+                pass  # e.g. nested deeper than orjson allows, json copes
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+    @staticmethod
+    def decode(text):
+        data = orjson.loads(text) if orjson is not None else json.loads(text)
+        return pythonToLua(data)
+
+
+def pythonToLua(data):
+    """Turn decoded JSON data back into Lua values for the current runtime."""
+    if isinstance(data, (dict, list)):
+        return currentLua().table_from(data, recursive=True)
+    return data
+
+
+def isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class MemoryStore:
+    """api.cache backend local to this process, with per-key expiry and an LRU limit."""
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()  # key -> (value, expires)
+        self.lock = threading.Lock()
+
+    def reset(self):
+        pass
+
+    def lookup(self, key):
+        """Return the live entry for key; the caller holds the lock."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def store(self, key, value, expires):
+        self.entries.pop(key, None)
+        self.entries[key] = (value, expires)
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.lookup(key)
+        return None if entry is None else entry[0]
+
+    def set(self, key, value, expires):
+        with self.lock:
+            self.store(key, value, expires)
+
+    def incr(self, key, amount, expires):
+        with self.lock:
+            value, expires = self.lookup(key) or (0, expires)
+            if not isNumber(value):
+                raise ValueError(f"api.cache.incr: value of '{key}' is not a number")
+            self.store(key, value + amount, expires)
+            return value + amount
+
+    def delete(self, key):
+        with self.lock:
+            return self.entries.pop(key, None) is not None
+
+
+# Seconds between updates of a shared cache key's last use, so that most
+# reads don't have to wait for the write lock
+CACHE_TOUCH_INTERVAL = 10
 
 
-luaGlobals = lua.globals()
-with open("json.lua", "r") as file:
-    luaGlobals.json = lua.execute(file.read())
+class SharedStore:
+    """api.cache backend in a SQLite file in shared memory, seen by every worker process.
+
+    Numbers are stored as SQLite numbers so incr can update them in one
+    statement, everything else is stored as JSON text.
+    """
+
+    def __init__(self, path, maxSize):
+        self.maxSize = maxSize
+        self.writes = 0
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(path + suffix)
+            except Exception:
+                pass
+        # Nothing here has to survive a crash, so skip syncing to disk
+        self.db = Database(path, "OFF", mmapSize=64 * 1024 * 1024)
+        self.db.write(self.createTable)
+
+    @staticmethod
+    def createTable(connection):
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS CacheEntry (key TEXT PRIMARY KEY, value, expires REAL, used REAL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS CacheEntryUsed ON CacheEntry (used)")
+
+    def reset(self):
+        self.db.reset()
+
+    @staticmethod
+    def encode(value):
+        return value if isNumber(value) else json.dumps(value, ensure_ascii=False)
+
+    @staticmethod
+    def decode(value):
+        return json.loads(value) if isinstance(value, str) else value
+
+    def written(self, connection):
+        """Every so often drop expired keys and the least recently used overflow."""
+        self.writes += 1
+        if self.writes % 64 == 0:
+            connection.execute("DELETE FROM CacheEntry WHERE expires <= ?", (time.time(),))
+            connection.execute(
+                "DELETE FROM CacheEntry WHERE key IN "
+                "(SELECT key FROM CacheEntry ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.maxSize,),
+            )
+
+    def get(self, key):
+        now = time.time()
+        row = self.db.execute(
+            "SELECT value, used FROM CacheEntry WHERE key = ? AND (expires IS NULL OR expires > ?)",
+            (key, now),
+        ).fetchone()
+        if row is None:
+            return None
+        if now - row[1] >= CACHE_TOUCH_INTERVAL:
+            # Dropping the least recently used keys only needs a rough idea of when they were used
+            self.db.write(
+                lambda connection: connection.execute(
+                    "UPDATE CacheEntry SET used = ? WHERE key = ?", (now, key)
+                )
+            )
+        return self.decode(row[0])
+
+    def set(self, key, value, expires):
+        def work(connection):
+            connection.execute(
+                "INSERT OR REPLACE INTO CacheEntry (key, value, expires, used) VALUES (?, ?, ?, ?)",
+                (key, self.encode(value), expires, time.time()),
+            )
+            self.written(connection)
+
+        self.db.write(work)
+
+    def incr(self, key, amount, expires):
+        def work(connection):
+            rows = connection.execute(
+                """INSERT INTO CacheEntry (key, value, expires, used)
+                VALUES (:key, :amount, :expires, :now)
+                ON CONFLICT (key) DO UPDATE SET
+                    value = CASE WHEN expires <= :now THEN excluded.value ELSE value + excluded.value END,
+                    expires = CASE WHEN expires <= :now THEN excluded.expires ELSE expires END,
+                    used = excluded.used
+                WHERE expires <= :now OR typeof(value) IN ('integer', 'real')
+                RETURNING value""",
+                {"key": key, "amount": amount, "expires": expires, "now": time.time()},
+            ).fetchall()
+            self.written(connection)
+            return rows
+
+        rows = self.db.write(work)
+        if not rows:
+            raise ValueError(f"api.cache.incr: value of '{key}' is not a number")
+        return rows[0][0]
+
+    def delete(self, key):
+        return self.db.write(
+            lambda connection: connection.execute(
+                "DELETE FROM CacheEntry WHERE key = ?", (key,)
+            ).rowcount
+            > 0
+        )
+
+
+if app.config["CACHE_BACKEND"] == "shared":
+    keyValueStore = SharedStore(app.config["CACHE_SHARED_PATH"], app.config["CACHE_SIZE"])
+else:
+    keyValueStore = MemoryStore(app.config["CACHE_SIZE"])
+
+
+def expiresAt(ttl):
+    return time.time() + ttl if ttl else None
+
+
+class CacheApi:
+    """api.cache: a key/value store for Lua, plus dropping responses cached by routes."""
+
+    @staticmethod
+    def get(key, default=None):
+        value = keyValueStore.get(str(key))
+        return default if value is None else pythonToLua(value)
+
+    @staticmethod
+    def set(key, value, ttl=None):
+        if value is None:
+            keyValueStore.delete(str(key))
+        else:
+            keyValueStore.set(str(key), luaToPython(value), expiresAt(ttl))
+
+    @staticmethod
+    def incr(key, amount=1, ttl=None):
+        return keyValueStore.incr(str(key), amount, expiresAt(ttl))
+
+    @staticmethod
+    def delete(key):
+        return keyValueStore.delete(str(key))
+
+    @staticmethod
+    def purge(key):
+        responseCache.purge(key)
 
 
 class Api:
     http = HttpApi
-    json = luaGlobals.json
+    json = JsonApi
     os = OsApi
     html = HtmlApi
     util = UtilityApi
     list = SharedListApi
+    cache = CacheApi
 
 
-luaGlobals.api = Api
+def findModule(name):
+    """Map a module name like "a.b" to modules/a/b.lua (or modules/a/b/init.lua)."""
+    parts = str(name).split(".")
+    if not all(part and "/" not in part and "\\" not in part for part in parts):
+        return None
+    base = os.path.join(app.config["MODULES_FOLDER"], *parts)
+    for path in (base + ".lua", os.path.join(base, "init.lua")):
+        if os.path.isfile(path):
+            return path
+    return None
 
 
-# Load Modules Dynamically
-def loadModules():
-    modules = {}
-    moduleFolder = app.config["MODULES_FOLDER"]
-    if os.path.isdir(moduleFolder):
-        for moduleFile in os.listdir(moduleFolder):
-            if moduleFile.endswith(".lua"):
-                moduleName = os.path.splitext(moduleFile)[0]
-                with open(os.path.join(moduleFolder, moduleFile), "r") as file:
-                    luaScript = file.read()
-                    luaFunction = lua.execute(f"return function() {luaScript} end")
-                    modules[moduleName] = luaFunction
+def bytecodeCachePath(source, luaVersion):
+    """Where the compiled bytecode for this source is cached, or None if caching is off."""
+    folder = app.config["MODULE_CACHE_FOLDER"]
+    if not folder:
+        return None
+    version = ".".join(map(str, luaVersion))
+    key = hashlib.sha256(f"{version}\0{source}".encode("utf-8")).hexdigest()
+    return os.path.join(folder, key + ".luac")
+
+
+# Bytecode isn't valid UTF-8, so it can't be handed to Python as a string:
+# reading, dumping and writing it all happens on the Lua side
+MODULE_COMPILER = """
+function(source, chunkName, cachePath)
+    if cachePath then
+        local file = io.open(cachePath, "rb")
+        if file then
+            local bytecode = file:read("a")
+            file:close()
+            -- Bytecode from another Lua build fails to load, so just compile again
+            local chunk = load(bytecode, chunkName, "b")
+            if chunk then return chunk end
+        end
+    end
+    local chunk = assert(load(source, chunkName, "t"))
+    if cachePath then
+        -- Write to a temporary name first so nobody reads a half written file
+        local temporary = cachePath .. "." .. tostring(chunk):match("%x+$") .. ".tmp"
+        local file = io.open(temporary, "wb")
+        if file then
+            file:write(string.dump(chunk))
+            file:close()
+            if not os.rename(temporary, cachePath) then os.remove(temporary) end
+        end
+    end
+    return chunk
+end
+"""
+
+# require runs a module once per runtime and keeps what it returned, like
+# Lua's package.loaded
+LUA_REQUIRE = """
+local loadModule = ...
+local loaded = {}
+
+local function require(name)
+    local value = loaded[name]
+    if value ~= nil then return value end
+    local chunk = loadModule(name)
+    if not chunk then return "Module not found." end
+    value = chunk(name)
+    if value == nil then value = true end
+    loaded[name] = value
+    return value
+end
+
+return require, loaded
+"""
+
+
+class RouteCache:
+    """LRU cache of compiled Lua chunks, keyed by file path."""
+
+    def __init__(self, compiler, maxSize=1024):
+        self.compiler = compiler
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.watched = False
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        """Return the compiled chunk for path, recompiling it if the file changed."""
+        path = os.path.abspath(path)
+        signature = None
+        if not self.watched:
+            # Without a watcher, poll the mtime and size on every lookup
+            stat = os.stat(path)
+            signature = (stat.st_mtime_ns, stat.st_size)
+
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and (self.watched or entry[0] == signature):
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        with open(path, "r") as file:
+            compiled = self.compiler(file.read(), path)
+
+        with self.lock:
+            self.entries[path] = (signature, compiled)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+        return compiled
+
+    def invalidate(self, path=None):
+        """Drop one path, or everything when path is None."""
+        with self.lock:
+            if path is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(os.path.abspath(path), None)
 
-    return modules
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
 
 
-loadedModules = loadModules()
+class RouteWatcher(FileSystemEventHandler):
+    """Invalidate cached chunks when files under the watched folders change."""
 
+    def __init__(self):
+        self.caches = []
+        self.observer = None
+
+    def register(self, cache):
+        self.caches.append(cache)
+        cache.watched = self.observer is not None
+
+    def unregister(self, cache):
+        if cache in self.caches:
+            self.caches.remove(cache)
+
+    def start(self, folders):
+        if Observer is None:
+            print("watchdog is not installed, falling back to mtime polling.")
+            return
+        self.observer = Observer()
+        for folder in folders:
+            if os.path.isdir(folder):
+                self.observer.schedule(self, folder, recursive=True)
+        self.observer.daemon = True
+        self.observer.start()
+        for cache in self.caches:
+            cache.watched = True
+
+    def on_any_event(self, event):
+        # Reading a file (or a folder's mtime changing) doesn't change any routes
+        if event.event_type not in ("created", "deleted", "modified", "moved"):
+            return
+        if event.is_directory and event.event_type == "modified":
+            return
+        for path in (event.src_path, getattr(event, "dest_path", "")):
+            if path:
+                for cache in self.caches:
+                    cache.invalidate(os.fsdecode(path))
+
+
+# Instructions between two checks of a request's limits, and between two
+# samples when the request is being profiled
+LUA_HOOK_INTERVAL = 10000
+LUA_PROFILE_INTERVAL = 1000
+
+# Lua side of the request limits and the profiler, which share one count hook
+# (a Lua thread can only have one). The hook charges the instruction budget and
+# checks the deadline. Once a limit is hit it fires on every instruction, so a
+# pcall in the script can't swallow the error and carry on. When profiling, each
+# sample charges the time since the previous one to the stack that is running.
+LUA_LIMITS = """
+local now, interval, profileInterval = ...
+local sethook, getinfo, concat, pack, unpack = debug.sethook, debug.getinfo, table.concat, table.pack, table.unpack
+local running = coroutine.running
+local limits = {armed = false}
+local budget, deadline, count, lastSample = 0, 0, interval, 0
+local armedThread
+
+-- The running stack from level up, outermost frame first: "file:line;file:line"
+local function currentStack(level)
+    local frames, n = {}, 0
+    while true do
+        local info = getinfo(level + 1, "Sln")
+        if not info then break end
+        n = n + 1
+        if info.what == "C" then
+            frames[n] = "[C]:" .. (info.name or "?")
+        else
+            frames[n] = info.short_src .. ":" .. info.currentline
+        end
+        level = level + 1
+    end
+    for i = 1, n // 2 do
+        frames[i], frames[n - i + 1] = frames[n - i + 1], frames[i]
+    end
+    return concat(frames, ";")
+end
+
+local function record(stack, seconds)
+    local profile = limits.profile
+    profile[stack] = (profile[stack] or 0) + seconds
+end
+
+local function hook()
+    if not limits.armed then return end
+    if limits.profile then
+        local time = now()
+        record(currentStack(2), time - lastSample)
+        lastSample = time
+    end
+    if budget > 0 then
+        budget = budget - count
+        if budget <= 0 then limits.exceeded = "instructions" end
+    end
+    if not limits.exceeded and deadline > 0 and now() >= deadline then
+        limits.exceeded = "timeout"
+    end
+    if limits.exceeded then
+        sethook(hook, "", 1)
+        -- Hit in a coroutine, whose error resume just returns: the thread the
+        -- limits were armed on has to fail too once it gets control back
+        if armedThread ~= running() then sethook(armedThread, hook, "", 1) end
+        if limits.exceeded == "timeout" then
+            error("Lua route timed out", 0)
+        end
+        error("Lua route went over its instruction limit", 0)
+    end
+end
+
+-- thread defaults to the running one (asgi.py arms each request coroutine)
+function limits.arm(instructions, seconds, profile, thread)
+    limits.armed, limits.exceeded, limits.profile = true, nil, profile
+    budget = instructions
+    deadline = seconds > 0 and now() + seconds or 0
+    count = profile and profileInterval or interval
+    lastSample = now()
+    armedThread = thread or running()
+    if thread then sethook(thread, hook, "", count) else sethook(hook, "", count) end
+end
+
+-- Coroutines keep their hook (see below), but it does nothing once armed is
+-- false. Python clears armed first, since the hook may be firing on every
+-- instruction by then.
+function limits.disarm(thread)
+    armedThread = nil
+    if thread then sethook(thread) else sethook() end
+end
+
+-- Lua keeps hook functions per thread, so a new coroutine doesn't inherit the
+-- hook of the thread that made it. coroutine.create and coroutine.wrap hook
+-- the coroutine as it starts instead, so a script can't run one to get around
+-- the limits, and a wrapped one can be a streamed response body. This
+-- includes coroutines made outside a request (e.g. by a module) and resumed
+-- in one, which is why it hooks them whether or not the limits are armed.
+local create, wrap = coroutine.create, coroutine.wrap
+
+local function hooked(body)
+    -- Anything but a function is left to create to reject
+    if type(body) ~= "function" then return body end
+    return function(...)
+        sethook(hook, "", count)
+        return body(...)
+    end
+end
+
+function coroutine.create(body)
+    return create(hooked(body))
+end
+
+function coroutine.wrap(body)
+    return wrap(hooked(body))
+end
+
+-- Instructions left of the budget given to arm (0 = unlimited)
+function limits.remaining()
+    return budget
+end
+
+-- Wraps a Python api function so a profiled request charges its time to
+-- "<caller's stack>;api.name" (the hook can't sample while Python runs)
+function limits.wrap(name, fn)
+    return function(...)
+        if not limits.profile then return fn(...) end
+        local start = now()
+        local stack = currentStack(2)
+        record(stack, start - lastSample)
+        local results = pack(fn(...))
+        lastSample = now()
+        record(stack .. ";" .. name, lastSample - start)
+        return unpack(results, 1, results.n)
+    end
+end
+
+return limits
+"""
+
+# api.list.iterate(listId, pageSize): a for-loop iterator over (index, item)
+# that fetches pageSize items per call to getRange, so walking a long list
+# costs one trip into Python per page and never holds more than a page.
+LIST_ITERATOR = """
+local getRange = ...
+return function(listId, pageSize)
+    pageSize = pageSize or 100
+    local page, size, offset, base, finished = nil, 0, 0, 0, false
+    return function()
+        offset = offset + 1
+        if offset > size then
+            if finished then
+                return nil
+            end
+            base = base + size
+            page = getRange(listId, base + 1, pageSize)
+            size, offset = #page, 1
+            finished = size < pageSize
+            if size == 0 then
+                return nil
+            end
+        end
+        return base + offset, page[offset]
+    end
+end
+"""
+
+# The requestData table handed to Lua handlers. Fields are fetched from the
+# LazyRequest the first time they are read and then kept in the table, so a
+# handler that never looks at the body or headers doesn't pay for them.
+LAZY_REQUEST = """
+local next, pairs, rawset, setmetatable = next, pairs, rawset, setmetatable
+local fields = {
+    body = true, headers = true, urlArguments = true, form = true,
+    files = true, cookies = true, path = true,
+}
+local sources = setmetatable({}, {__mode = "k"})
+local methods = {}
+
+function methods:read(size)
+    return sources[self].read(size)
+end
+
+function methods:lines()
+    local source = sources[self]
+    return function() return source.readLine() end
+end
+
+local meta = {}
+
+function meta.__index(request, key)
+    if fields[key] then
+        local value = sources[request].load(key)
+        rawset(request, key, value)
+        return value
+    end
+    return methods[key]
+end
+
+-- pairs() sees every field, like the table used to have
+function meta.__pairs(request)
+    for key in pairs(fields) do
+        local _ = request[key]
+    end
+    return next, request, nil
+end
+
+return function(method, source)
+    local request = setmetatable({method = method}, meta)
+    sources[request] = source
+    return request
+end
+"""
+
+# Status code for each limit a request can go over
+LIMIT_STATUS = {"timeout": 504, "instructions": 503, "memory": 503}
+LIMIT_MESSAGES = {
+    "timeout": "Lua route timed out",
+    "instructions": "Lua route went over its instruction limit",
+    "memory": "Lua route went over its memory limit",
+}
+
+
+class LimitExceeded(Exception):
+    """Lua code run for a request on another runtime went over one of its limits."""
+
+    def __init__(self, kind):
+        super().__init__(LIMIT_MESSAGES[kind])
+        self.kind = kind
+
+
+class LuaState:
+    """One LuaRuntime with json, api, require and the modules wired up."""
 
-# Automatically call module named "_"
-if "_" in loadedModules:
-    loadedModules["_"]()
+    def __init__(self):
+        self.lua = LuaRuntime(
+            unpack_returned_tuples=True,
+            max_memory=app.config["LUA_MEMORY_LIMIT"] or None,
+        )
+        self.requests = 0
+        self.memory = 0  # Measured after each request, for the metrics
+        luaGlobals = self.lua.globals()
+        # Kept before any script can replace the global, and called directly
+        # so measuring memory after each request doesn't compile anything
+        self.collectGarbage = luaGlobals.collectgarbage
+        # Compile a chunk with its file name so Lua errors point at the right file.
+        # The embedded sources below are named after where they live, so their
+        # frames are recognisable in errors and profiles too
+        self.compileChunk = self.lua.eval(
+            'function(source, name, ...) return assert(load(source, "@" .. name))(...) end'
+        )
 
+        with open("json.lua", "r") as file:
+            luaGlobals.json = self.compileChunk(file.read(), "json.lua")
+
+        api = self.lua.table()
+        for name in ("http", "json", "os", "html", "util", "cache"):
+            api[name] = getattr(Api, name)
+        luaGlobals.api = self.api = api
+
+        # api.list is a Lua table so iterate can page through a list in Lua
+        sharedList = self.lua.table()
+        for name in dir(SharedListApi):
+            if not name.startswith("_"):
+                sharedList[name] = getattr(SharedListApi, name)
+        sharedList.iterate = self.compileChunk(
+            LIST_ITERATOR, "main.py:LIST_ITERATOR", SharedListApi.getRange
+        )
+        api.list = sharedList
+
+        # api.html is a Lua table so the builder can be pure Lua
+        with open("builder.lua", "r") as file:
+            htmlBuilder = self.compileChunk(file.read(), "builder.lua")
+        html = self.lua.table(builder=htmlBuilder.new)
+        for name in ("serveHtml", "serveError", "legacyBuilder"):
+            html[name] = getattr(HtmlApi, name)
+        api.html = html
+
+        self.compileModule = self.compileChunk(
+            "return " + MODULE_COMPILER, "main.py:MODULE_COMPILER"
+        )
+        luaGlobals.require, self.loadedModules = self.compileChunk(
+            LUA_REQUIRE, "main.py:LUA_REQUIRE", self.loadModule
+        )
 
-# Modify require behavior to load from modules if available
-def customRequire(moduleName):
-    if moduleName in loadedModules:
-        return loadedModules[moduleName]()
-    else:
-        return "Module not found."
+        self.newRequest = self.compileChunk(LAZY_REQUEST, "main.py:LAZY_REQUEST")
 
+        # A table's address, which luaToPython uses to spot cycles
+        self.tableId = self.compileChunk(
+            'return function(t) return string.format("%p", t) end', "main.py:tableId"
+        )
+        self.limits = self.compileChunk(
+            LUA_LIMITS,
+            "main.py:LUA_LIMITS",
+            time.perf_counter,
+            LUA_HOOK_INTERVAL,
+            LUA_PROFILE_INTERVAL,
+        )
+        # A coroutine can't cross into Python, so wrap a streamed one in an iterator
+        self.prepareResult = self.compileChunk(
+            """return function(result)
+                local body = type(result) == "table" and result.response
+                if type(body) == "thread" then
+                    result.response = function()
+                        if coroutine.status(body) == "dead" then return nil end
+                        local ok, chunk = coroutine.resume(body)
+                        if not ok then error(chunk, 0) end
+                        return chunk
+                    end
+                end
+                return result
+            end""",
+            "main.py:prepareResult",
+        )
+        self.profiledApi = None
+        self.deadline = None  # When the current limited() block times out, if it can
+        # A route file returns its handler, optionally followed by an options table
+        self.compileRouteChunk = self.compileChunk(
+            """return function(source, name)
+                local handler, options = assert(load(source, "@" .. name))()
+                return handler, type(options) == "table" and options.concurrency or nil
+            end""",
+            "main.py:compileRouteChunk",
+        )
+        self.routeCache = RouteCache(self.compileRoute, app.config["ROUTE_CACHE_SIZE"])
+        self.templateCache = RouteCache(self.compileTemplate, app.config["ROUTE_CACHE_SIZE"])
+        self.compiledBlocks = {}  # <$lua async> blocks, by source
+        routeWatcher.register(self.routeCache)
+        routeWatcher.register(self.templateCache)
+
+        # Automatically call module named "_"
+        if findModule("_") is not None:
+            with useLuaState(self):
+                luaGlobals.require("_")
+        self.memory = self.memoryUsed()
+
+    def compileRoute(self, source, path):
+        """Compile a route file and note the options it returned for admission."""
+        handler, concurrency = self.compileRouteChunk(source, os.path.relpath(path))
+        admission.declare(path, concurrency)
+        return handler
+
+    def compileTemplate(self, source, path):
+        """Compile an .shtml file into its render function."""
+        name = os.path.relpath(path)
+        luaSource, asyncBlocks = compileShtml(source, name)
+        return self.compileChunk(
+            luaSource, name, formatShtmlError, FragmentCache, partial(AsyncBlockJobs, asyncBlocks)
+        )
 
-luaGlobals.require = customRequire
+    def loadModule(self, moduleName):
+        """Compile a module for require, from the bytecode cache when it's there."""
+        path = findModule(moduleName)
+        if path is None:
+            return None
+        with open(path, "r") as file:
+            source = file.read()
+        return self.compileModule(
+            source,
+            "@" + os.path.relpath(path),
+            bytecodeCachePath(source, self.lua.lua_version),
+        )
 
+    @contextmanager
+    def limited(self, instructions, seconds, profileName=None):
+        """Abort Lua code in the block after too many instructions or seconds.
+
+        With a profileName the block is also profiled, and its samples are
+        added to the profiler under that name.
+        """
+        luaGlobals = self.lua.globals()
+        if profileName is not None:
+            luaGlobals.api = self.createProfiledApi()
+        self.limits.arm(
+            instructions, seconds, self.lua.table() if profileName is not None else None
+        )
+        # Work handed to other runtimes (async blocks) has to finish by then too
+        self.deadline = time.monotonic() + seconds if seconds > 0 else None
+        try:
+            yield
+        finally:
+            self.deadline = None
+            self.limits.armed = False
+            profile = self.limits.profile
+            self.limits.profile = None
+            self.limits.disarm()
+            if profileName is not None:
+                luaGlobals.api = self.api
+                profiler.add(profileName, profile.items())
+
+    def createProfiledApi(self):
+        """A copy of the api table whose Python functions are timed by the profiler."""
+        if self.profiledApi is not None:
+            return self.profiledApi
+        profiledApi = self.lua.table()
+        for name, namespace in self.api.items():
+            functions = self.lua.table()
+            if lua_type(namespace) == "table":
+                entries = namespace.items()
+            else:
+                entries = (
+                    (attribute, getattr(namespace, attribute))
+                    for attribute in dir(namespace)
+                    if not attribute.startswith("_")
+                )
+            for attribute, function in entries:
+                if lua_type(function) is None and callable(function):
+                    function = self.limits.wrap(f"api.{name}.{attribute}", function)
+                functions[attribute] = function
+            profiledApi[name] = functions
+        self.profiledApi = profiledApi
+        return profiledApi
+
+    def exceededLimit(self, error):
+        """Which limit, if any, caused error: "timeout", "instructions" or "memory"."""
+        if isinstance(error, (LuaMemoryError, MemoryError)):
+            return "memory"
+        if isinstance(error, LimitExceeded):
+            return error.kind
+        return self.limits.exceeded
+
+    def memoryUsed(self):
+        """Bytes currently allocated by this Lua state."""
+        return int(self.collectGarbage("count") * 1024)
+
+    def close(self):
+        routeWatcher.unregister(self.routeCache)
+        routeWatcher.unregister(self.templateCache)
+
+
+luaContext = threading.local()
+
+
+def currentLua():
+    """Return the LuaRuntime the current thread has checked out."""
+    return luaContext.state.lua
+
+
+@contextmanager
+def useLuaState(state):
+    """Make state the current thread's runtime for the duration of the block."""
+    previous = getattr(luaContext, "state", None)
+    luaContext.state = state
+    try:
+        yield state
+    finally:
+        luaContext.state = previous
+
+
+class LuaRuntimePool:
+    """Up to size LuaStates that requests check out one at a time.
+
+    States are created when first needed, so a process that never serves a
+    request (like the prefork master) never builds any.
+    """
+
+    def __init__(self, size, maxRequests=0, maxMemory=0):
+        self.size = size
+        self.maxRequests = maxRequests
+        self.maxMemory = maxMemory
+        self.idle = []  # Most recently used last, so busy states stay warm
+        self.states = []
+        self.creating = 0
+        # Guards the lists above and wakes a waiting acquire when a state is
+        # released, or discarded (which leaves room to create one)
+        self.condition = threading.Condition()
+        # Cache counters of replaced runtimes, so the totals never go down
+        self.retiredStats = {
+            "route": {"hits": 0, "misses": 0},
+            "template": {"hits": 0, "misses": 0},
+        }
 
-def getRequestData():
-    """Retrieve request data for Lua scripts."""
-    # Get the request body as a string
-    body = request.get_data(as_text=True)
-
-    return lua.table_from(
-        {
-            "urlArguments": lua.table_from(dict(request.args)),
-            "headers": lua.table_from(dict(request.headers)),
-            "method": request.method,
-            "body": body,
+    def hasRoom(self):
+        return len(self.states) + self.creating < self.size
+
+    def acquire(self, timeout=None):
+        """A state, waiting up to timeout seconds for one (None = as long as it takes).
+
+        Returns None if none was free in time.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            state = self.tryAcquire()
+            if state is not None:
+                return state
+            with self.condition:
+                if self.idle or self.hasRoom():
+                    continue
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def tryAcquire(self):
+        """A free state, or None if every state is checked out."""
+        with self.condition:
+            if self.idle:
+                return self.idle.pop()
+            if not self.hasRoom():
+                return None
+            self.creating += 1
+        # Building a state takes a while, so it happens outside the lock
+        state = None
+        try:
+            state = LuaState()
+        finally:
+            with self.condition:
+                self.creating -= 1
+                if state is not None:
+                    self.states.append(state)
+                else:
+                    self.condition.notify()
+        return state
+
+    def idleCount(self):
+        """States not checked out, counting the ones not created yet."""
+        with self.condition:
+            return len(self.idle) + self.size - len(self.states) - self.creating
+
+    def release(self, state, discard=False):
+        """Return a state to the pool, replacing it if it is due for recycling."""
+        state.requests += 1
+        if not discard:
+            state.memory = state.memoryUsed()
+        if (
+            discard
+            or (self.maxRequests and state.requests >= self.maxRequests)
+            or (self.maxMemory and state.memory >= self.maxMemory)
+        ):
+            for name, cache in (
+                ("route", state.routeCache),
+                ("template", state.templateCache),
+            ):
+                stats = cache.stats()
+                for key in ("hits", "misses"):
+                    self.retiredStats[name][key] += stats[key]
+            state.close()
+            with self.condition:
+                self.states.remove(state)
+                # A waiting acquire creates its replacement
+                self.condition.notify()
+            return
+        with self.condition:
+            self.idle.append(state)
+            self.condition.notify()
+
+    def cacheStats(self):
+        """Route and template cache counters summed over every runtime in the pool."""
+        totals = {
+            name: dict(retired, size=0) for name, retired in self.retiredStats.items()
         }
+        for state in list(self.states):
+            for name, cache in (
+                ("route", state.routeCache),
+                ("template", state.templateCache),
+            ):
+                for key, value in cache.stats().items():
+                    totals[name][key] += value
+        return totals
+
+    @contextmanager
+    def checkout(self):
+        state = self.acquire()
+        try:
+            with useLuaState(state):
+                yield state
+        finally:
+            self.release(state)
+
+
+if app.config["MODULE_CACHE_FOLDER"]:
+    os.makedirs(app.config["MODULE_CACHE_FOLDER"], exist_ok=True)
+
+routeWatcher = RouteWatcher()
+
+luaPool = LuaRuntimePool(
+    app.config["LUA_RUNTIMES"],
+    app.config["LUA_RUNTIME_MAX_REQUESTS"],
+    app.config["LUA_RUNTIME_MAX_MEMORY"],
+)
+
+
+def collectCacheStats(key):
+    stats = luaPool.cacheStats()
+    return [({"cache": name}, counts[key]) for name, counts in stats.items()]
+
+
+metrics.counter(
+    "luaflask_route_cache_hits_total",
+    "Compiled route and template cache hits.",
+    partial(collectCacheStats, "hits"),
+)
+metrics.counter(
+    "luaflask_route_cache_misses_total",
+    "Compiled route and template cache misses (compiles).",
+    partial(collectCacheStats, "misses"),
+)
+metrics.gauge(
+    "luaflask_route_cache_entries",
+    "Compiled routes and templates held in memory.",
+    partial(collectCacheStats, "size"),
+)
+metrics.gauge(
+    "luaflask_lua_memory_bytes",
+    "Memory used by each Lua runtime, as of its last request.",
+    lambda: [({"runtime": index}, state.memory) for index, state in enumerate(list(luaPool.states))],
+)
+metrics.gauge(
+    "luaflask_lua_runtimes_idle",
+    "Lua runtimes not checked out by a request.",
+    lambda: [({}, luaPool.idleCount())],
+)
+
+
+def initWorker():
+    """Give a forked worker process its own database connection and Lua runtimes."""
+    global luaPool
+    database.reset()
+    responseCache.reset()
+    keyValueStore.reset()
+    routeWatcher.caches.clear()
+    routeWatcher.register(routeIndex)
+    luaPool = LuaRuntimePool(
+        app.config["LUA_RUNTIMES"],
+        app.config["LUA_RUNTIME_MAX_REQUESTS"],
+        app.config["LUA_RUNTIME_MAX_MEMORY"],
+    )
+    startBackgroundThreads()
+
+
+backgroundPid = None
+backgroundLock = threading.Lock()
+
+
+def startBackgroundThreads():
+    """Start the route watcher and route index polling in this process.
+
+    They start with the first request rather than on import, so the prefork
+    master forks its workers without any threads running, and each worker
+    starts its own (threads don't survive a fork).
+    """
+    global backgroundPid
+    with backgroundLock:
+        if backgroundPid == os.getpid():
+            return
+        backgroundPid = os.getpid()
+        if app.config["ROUTE_CACHE_WATCH"]:
+            routeWatcher.start([app.config["ROUTES_FOLDER"]])
+        routeIndex.startPolling()
+
+
+class LazyRequest:
+    """Builds the requestData fields of one request when Lua first reads them."""
+
+    def __init__(self, req):
+        self.request = req
+
+    def load(self, name):
+        req = self.request
+        lua = currentLua()
+        if name == "body":
+            return req.get_data(as_text=True)
+        elif name == "headers":
+            return lua.table_from(dict(req.headers))
+        elif name == "urlArguments":
+            return lua.table_from(dict(req.args))
+        elif name == "form":
+            return lua.table_from(dict(req.form))
+        elif name == "files":
+            return lua.table_from(
+                {
+                    field: lua.table_from(
+                        {
+                            "filename": upload.filename,
+                            "type": upload.mimetype,
+                            "read": upload.stream.read,
+                            "save": upload.save,
+                        }
+                    )
+                    for field, upload in req.files.items()
+                }
+            )
+        elif name == "cookies":
+            return lua.table_from(dict(req.cookies))
+        elif name == "path":
+            return req.path
+        return None
+
+    def read(self, size=None):
+        """Up to size bytes of the body, or the rest of it without a size."""
+        return self.request.stream.read(-1 if size is None else int(size))
+
+    def readLine(self):
+        """The next line of the body without its line ending, or None at the end."""
+        line = self.request.stream.readline()
+        if not line:
+            return None
+        return line.removesuffix(b"\n").removesuffix(b"\r")
+
+
+def getRequestData():
+    """Retrieve request data for Lua scripts. Fields are only built when read."""
+    return luaContext.state.newRequest(
+        request.method, LazyRequest(request._get_current_object())
+    )
+
+
+class StatCache:
+    """Short-lived cache of os.stat results for regular files (None if missing)."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+
+    def get(self, path):
+        now = time.monotonic()
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        try:
+            result = os.stat(path)
+            if not stat.S_ISREG(result.st_mode):
+                result = None
+        except (OSError, ValueError):
+            result = None
+        if len(self.entries) > 10000:
+            self.entries.clear()
+        self.entries[path] = (now + self.ttl, result)
+        return result
+
+    def forget(self, path):
+        self.entries.pop(path, None)
+
+
+statCache = StatCache(app.config["STATIC_STAT_TTL"])
+
+
+class ErrorPages:
+    """The error pages, read once so serving them doesn't touch the disk."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.pages = {}
+        self.signature = None
+        self.load()
+
+    def currentSignature(self):
+        """The pages' names and modification times, to notice edits."""
+        try:
+            return sorted(
+                (entry.name, entry.stat().st_mtime_ns)
+                for entry in os.scandir(self.folder)
+                if entry.name.endswith(".html")
+            )
+        except OSError:
+            return None
+
+    def changed(self):
+        return self.currentSignature() != self.signature
+
+    def load(self):
+        self.signature = self.currentSignature()
+        pages = {}
+        if os.path.isdir(self.folder):
+            for fileName in os.listdir(self.folder):
+                if fileName.endswith(".html"):
+                    with open(os.path.join(self.folder, fileName), "r") as file:
+                        pages[fileName[: -len(".html")]] = file.read()
+        self.pages = pages
+
+    def get(self, name):
+        return self.pages.get(str(name))
+
+
+class RouteIndex:
+    """Maps URL paths to (kind, file) for everything under the routes folder.
+
+    Built once by walking the folder, then kept up to date by the watcher (one
+    path at a time) or, without one, by checking the folders' modification
+    times every ROUTE_INDEX_POLL seconds and rescanning when one changed.
+    Resolving a request is then a dictionary lookup.
+    """
+
+    def __init__(self, folder, pollInterval):
+        self.folder = folder
+        self.pollInterval = pollInterval
+        self.routes = {}
+        self.directories = {}  # folder -> mtime when it was scanned
+        self.recheck = False
+        self.watched = False
+        self.build()
+
+    def probe(self, subpath):
+        """Resolve one URL path against the disk, in the order routes take priority."""
+        if subpath == "":
+            luaPath = os.path.join(self.folder, "_.lua")
+        else:
+            luaPath = os.path.join(self.folder, subpath, "_.lua")
+
+        # If default route file doesn’t exist, check for specific file
+        if not os.path.isfile(luaPath):
+            luaPath = os.path.join(self.folder, f"{subpath}.lua")
+        if os.path.isfile(luaPath):
+            return ("lua", luaPath)
+
+        filePath = os.path.join(self.folder, subpath)
+        if os.path.isfile(filePath):
+            return ("shtml" if subpath.endswith(".shtml") else "file", filePath)
+        return None
+
+    def keysFor(self, relPath):
+        """The URL paths a file under the routes folder could answer."""
+        keys = [relPath]
+        if relPath.endswith(".lua"):
+            keys.append(relPath[: -len(".lua")])
+            directory, fileName = posixpath.split(relPath)
+            if fileName == "_.lua":
+                keys.append(directory)
+                if directory:
+                    keys.append(directory + "/")
+        return keys
+
+    def build(self):
+        routes = {}
+        directories = {}
+        for directory, _, fileNames in os.walk(self.folder):
+            try:
+                directories[directory] = os.stat(directory).st_mtime_ns
+            except OSError:
+                directories[directory] = None
+            for fileName in fileNames:
+                relPath = os.path.relpath(os.path.join(directory, fileName), self.folder)
+                for key in self.keysFor(relPath.replace(os.sep, "/")):
+                    if key not in routes:
+                        route = self.probe(key)
+                        if route is not None:
+                            routes[key] = route
+        self.routes = routes
+        self.directories = directories
+        # A folder changed within the last second might have changed again
+        # after it was listed without its mtime moving, so look again next poll
+        recent = time.time_ns() - 1_000_000_000
+        self.recheck = any(mtime is None or mtime > recent for mtime in directories.values())
+        errorPages.load()
+
+    def changed(self):
+        """Whether a file or folder was added, removed or renamed since the last build."""
+        if self.recheck:
+            return True
+        for directory, mtime in list(self.directories.items()):
+            try:
+                if os.stat(directory).st_mtime_ns != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def invalidate(self, path):
+        """Update the routes a changed file affects (called by the watcher)."""
+        absolutePath = os.path.abspath(path)
+        relPath = os.path.relpath(absolutePath, os.path.abspath(self.folder))
+        if relPath.startswith(".."):
+            return
+        if os.path.isdir(absolutePath) or not os.path.exists(absolutePath) and any(
+            route[1].startswith(os.path.join(self.folder, relPath, ""))
+            for route in list(self.routes.values())
+        ):
+            # A whole directory appeared or went away
+            self.build()
+            return
+
+        for key in self.keysFor(relPath.replace(os.sep, "/")):
+            route = self.probe(key)
+            if route is None:
+                self.routes.pop(key, None)
+            else:
+                self.routes[key] = route
+        if os.path.dirname(absolutePath) == os.path.abspath(errorPages.folder):
+            errorPages.load()
+
+    def resolve(self, subpath):
+        return self.routes.get(subpath)
+
+    def poll(self):
+        while not self.watched:
+            time.sleep(self.pollInterval)
+            if self.watched:
+                break
+            if self.changed():
+                self.build()
+            elif errorPages.changed():
+                errorPages.load()
+
+    def startPolling(self):
+        if self.pollInterval and not self.watched:
+            threading.Thread(target=self.poll, daemon=True).start()
+
+
+errorPages = ErrorPages(app.config["ERRORS_FOLDER"])
+routeIndex = RouteIndex(app.config["ROUTES_FOLDER"], app.config["ROUTE_INDEX_POLL"])
+routeWatcher.register(routeIndex)
+
+
+class CachedResponse:
+    """A rendered Lua response with its freshness, ready to be served again."""
+
+    def __init__(self, tag, ttl, swr, status, contentType, headers, body, created=None):
+        self.tag = tag
+        self.ttl = ttl
+        self.swr = swr
+        self.status = status
+        self.contentType = contentType
+        self.headers = headers
+        self.body = body
+        # Wall clock time, so entries from the database tier age correctly
+        self.created = time.time() if created is None else created
+        self.compressedBodies = {}  # encoding -> body, filled in as clients ask
+
+    def age(self):
+        return time.time() - self.created
+
+    def isFresh(self):
+        return self.age() < self.ttl
+
+    def isUsable(self):
+        """Fresh, or stale but still inside the stale-while-revalidate window."""
+        return self.age() < self.ttl + self.swr
+
+    def toResponse(self):
+        response = Response(
+            self.body,
+            status=self.status,
+            content_type=self.contentType,
+            headers=self.headers,
+        )
+        response.headers["Age"] = str(int(self.age()))
+        return compressResponse(response, self.compressed)
+
+    def compressed(self, encoding):
+        body = self.compressedBodies.get(encoding)
+        if body is None:
+            body = self.compressedBodies[encoding] = compressBody(self.body, encoding)
+        return body
+
+
+class ResponseCache:
+    """LRU of Lua responses for routes that returned a cache table.
+
+    Entries are keyed by route, full URL and the request headers the route
+    varies on. The route's last cache table says which headers those are, so a
+    route only becomes cacheable after it has run once.
+    """
+
+    def __init__(self, maxSize, dbPath=None):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.tags = {}  # tag -> keys, for purging
+        self.varies = {}  # route path -> header names it varies on
+        self.flights = {}  # key -> [lock, waiting requests, whether it's open]
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.db = None
+        if dbPath:
+            self.db = Database(dbPath)
+            self.db.write(self.createTable)
+
+    @staticmethod
+    def createTable(connection):
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS CachedResponse (
+                key TEXT PRIMARY KEY, tag TEXT, created REAL, ttl REAL, swr REAL,
+                status INTEGER, contentType TEXT, headers TEXT, body BLOB
+            )"""
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS CachedResponseTag ON CachedResponse (tag)"
+        )
+
+    def reset(self):
+        """Drop database connections, e.g. after forking into a worker process."""
+        if self.db is not None:
+            self.db.reset()
+
+    def isCacheable(self, path):
+        return (
+            self.maxSize > 0
+            and request.method in ("GET", "HEAD")
+            and path in self.varies
+        )
+
+    def keyFor(self, path, vary=None):
+        if vary is None:
+            vary = self.varies[path]
+        headers = [f"{name}: {request.headers.get(name, '')}" for name in vary]
+        return "\n".join([path, request.url] + headers)
+
+    def get(self, key):
+        """Return a usable entry for key (possibly stale), or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is None and self.db is not None:
+            row = self.db.execute(
+                "SELECT tag, ttl, swr, status, contentType, headers, body, created "
+                "FROM CachedResponse WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is not None:
+                tag, ttl, swr, status, contentType, headers, body, created = row
+                entry = CachedResponse(
+                    tag, ttl, swr, status, contentType, json.loads(headers), body, created
+                )
+                with self.lock:
+                    self.remember(key, entry)
+        if entry is None or not entry.isUsable():
+            return None
+        return entry
+
+    def remember(self, key, entry):
+        """Add an entry to the memory tier; the caller holds the lock."""
+        self.discard(key)
+        self.entries[key] = entry
+        self.tags.setdefault(entry.tag, set()).add(key)
+        while len(self.entries) > self.maxSize:
+            self.discard(next(iter(self.entries)))
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            keys = self.tags.get(entry.tag)
+            keys.discard(key)
+            if not keys:
+                del self.tags[entry.tag]
+
+    def store(self, path, cacheSpec, response):
+        """Remember a route's response according to the cache table it returned."""
+        if response.status_code >= 500:
+            # A failed render says nothing about how the route is cached
+            return
+        if cacheSpec is None or not cacheSpec["ttl"]:
+            # The route stopped asking to be cached
+            self.varies.pop(path, None)
+            return
+        vary = list(cacheSpec["vary"].values()) if cacheSpec["vary"] else []
+        # Tell downstream caches which request headers the output depends on
+        response.vary.update(vary)
+        if request.method not in ("GET", "HEAD"):
+            return
+        if "Set-Cookie" in response.headers:
+            # A cookie is meant for one client, so this response can't be shared,
+            # and the route is treated as uncacheable until it stops setting one
+            self.varies.pop(path, None)
+            return
+
+        key = self.keyFor(path, vary)
+        entry = CachedResponse(
+            str(cacheSpec["key"] or request.path),
+            float(cacheSpec["ttl"]),
+            float(cacheSpec["swr"] or 0),
+            response.status_code,
+            response.content_type,
+            [
+                (name, value)
+                for name, value in response.headers.items()
+                if name.lower() not in ("content-type", "content-length")
+            ],
+            response.get_data(),
+        )
+        with self.lock:
+            self.varies[path] = vary
+            self.remember(key, entry)
+            self.writes += 1
+            prune = self.writes % 100 == 0
+        if self.db is not None:
+            self.db.write(partial(self.storeRow, key, entry, prune))
+
+    @staticmethod
+    def storeRow(key, entry, prune, connection):
+        connection.execute(
+            "INSERT OR REPLACE INTO CachedResponse VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                key,
+                entry.tag,
+                entry.created,
+                entry.ttl,
+                entry.swr,
+                entry.status,
+                entry.contentType,
+                json.dumps(entry.headers),
+                entry.body,
+            ),
+        )
+        if prune:
+            # Every so often drop entries that can't be served any more
+            connection.execute(
+                "DELETE FROM CachedResponse WHERE created + ttl + swr < ?",
+                (time.time(),),
+            )
+
+    def purge(self, tag):
+        """Drop every entry stored under a cache key (the route's path by default)."""
+        with self.lock:
+            for key in list(self.tags.get(tag, ())):
+                self.discard(key)
+        if self.db is not None:
+            self.db.write(
+                lambda connection: connection.execute(
+                    "DELETE FROM CachedResponse WHERE tag = ?", (tag,)
+                )
+            )
+
+    @contextmanager
+    def flight(self, key, timeout):
+        """Let one request at a time render a missing key while the others wait.
+
+        Yields "lead" to the request that should render it, or "timeout" if
+        it waited more than timeout seconds. Once a render leaves nothing in
+        the cache (an error, or a response that can't be cached), the flight
+        is open: the requests still waiting yield "open" and run at the same
+        time instead of taking turns.
+        """
+        with self.lock:
+            flight = self.flights.setdefault(key, [threading.Lock(), 0, False])
+            flight[1] += 1
+        outcome = "open"
+        locked = False
+        try:
+            if not flight[2]:
+                locked = flight[0].acquire(timeout=timeout)
+                if not locked:
+                    outcome = "timeout"
+                elif not flight[2]:
+                    outcome = "lead"
+                else:
+                    flight[0].release()
+                    locked = False
+            yield outcome
+        finally:
+            with self.lock:
+                entry = self.entries.get(key)
+                if outcome == "lead" and (entry is None or not entry.isUsable()):
+                    flight[2] = True
+                flight[1] -= 1
+                if flight[1] == 0:
+                    del self.flights[key]
+            if locked:
+                flight[0].release()
+
+    def startRefresh(self, key):
+        """Claim the background refresh of a stale key, False if one is running."""
+        with self.lock:
+            if key in self.refreshing:
+                return False
+            self.refreshing.add(key)
+            return True
+
+    def endRefresh(self, key):
+        with self.lock:
+            self.refreshing.discard(key)
+
+
+responseCache = ResponseCache(
+    app.config["RESPONSE_CACHE_SIZE"], app.config["RESPONSE_CACHE_DB"]
+)
+
+
+# Preferred first; brotli is only offered for responses when it is installed
+COMPRESSED_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+
+def acceptedEncodings():
+    """The encodings in COMPRESSED_SUFFIXES this request accepts, preferred first."""
+    accepted = request.accept_encodings
+    return [encoding for encoding in COMPRESSED_SUFFIXES if accepted[encoding] > 0]
+
+
+def compressBody(body, encoding, best=False):
+    """Compress bytes with gzip or brotli, at the highest level if best is set."""
+    if encoding == "br":
+        quality = 11 if best else app.config["COMPRESS_BROTLI_QUALITY"]
+        return brotli.compress(body, quality=quality)
+    level = 9 if best else app.config["COMPRESS_GZIP_LEVEL"]
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+def isCompressibleType(mimeType):
+    return app.config["COMPRESS_MIN_SIZE"] is not None and mimeType in app.config["COMPRESS_TYPES"]
+
+
+def compressResponse(response, compressed=None):
+    """Compress a buffered response if the client accepts it and it is worth it.
+
+    compressed(encoding) can supply the compressed body instead, e.g. from a
+    cache entry that already compressed it once.
+    """
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or not 200 <= response.status_code < 300
+        or response.status_code == 204
+        or not isCompressibleType(response.mimetype)
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    if "Content-Encoding" in response.headers:
+        return response
+    if (response.content_length or 0) < app.config["COMPRESS_MIN_SIZE"]:
+        return response
+    for encoding in acceptedEncodings():
+        if encoding == "br" and brotli is None:
+            continue
+        if compressed is not None:
+            response.set_data(compressed(encoding))
+        else:
+            response.set_data(compressBody(response.get_data(), encoding))
+        response.headers["Content-Encoding"] = encoding
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f"{etag}-{encoding}", weak)
+        break
+    return response
+
+
+def findPrecompressed(path, fileStat):
+    """A .br/.gz copy of a file that the client accepts, as (encoding, path, stat)."""
+    for encoding in acceptedEncodings():
+        siblingPath = path + COMPRESSED_SUFFIXES[encoding]
+        siblingStat = statCache.get(siblingPath)
+        # A copy older than the file is out of date
+        if siblingStat is not None and siblingStat.st_mtime >= fileStat.st_mtime:
+            return encoding, siblingPath, siblingStat
+    return None
+
+
+def precompressFiles(folders):
+    """Write .gz (and .br with brotli) copies of compressible files that changed.
+
+    Returns how many copies were written.
+    """
+    encodings = [encoding for encoding in COMPRESSED_SUFFIXES if encoding != "br" or brotli]
+    written = 0
+    for folder in folders:
+        for root, _, files in os.walk(folder):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith((".gz", ".br", ".lua", ".shtml")):
+                    continue
+                if not isCompressibleType(guessMimeType(path)):
+                    continue
+                fileStat = os.stat(path)
+                if fileStat.st_size < app.config["COMPRESS_MIN_SIZE"]:
+                    continue
+                body = None
+                for encoding in encodings:
+                    siblingPath = path + COMPRESSED_SUFFIXES[encoding]
+                    try:
+                        if os.stat(siblingPath).st_mtime >= fileStat.st_mtime:
+                            continue
+                    except OSError:
+                        pass
+                    if body is None:
+                        with open(path, "rb") as file:
+                            body = file.read()
+                    compressed = compressBody(body, encoding, best=True)
+                    if len(compressed) >= len(body):
+                        continue
+                    # Write next to it and rename, so a request never sees half a file
+                    temporary = f"{siblingPath}.{os.getpid()}.tmp"
+                    with open(temporary, "wb") as file:
+                        file.write(compressed)
+                    os.replace(temporary, siblingPath)
+                    written += 1
+    return written
+
+
+@lru_cache(maxsize=1024)
+def guessMimeType(path):
+    mimeType, _ = mimetypes.guess_type(path)
+    return mimeType if mimeType else "application/octet-stream"
+
+
+def openStaticFile(path):
+    """Open a file statCache found, or return None (and forget it) if it is gone since."""
+    try:
+        return open(path, "rb")
+    except (FileNotFoundError, IsADirectoryError):
+        statCache.forget(path)
+        return None
+
+
+def serveStaticFile(path, fileStat):
+    """Serve a file with ETag/Last-Modified, conditional GET and byte ranges.
+
+    The body is handed to the server's wsgi.file_wrapper, so it is never read
+    into Python memory and the server can use sendfile where it supports it.
+    Returns None if the file was deleted since it was stat'ed.
+    """
+    mimeType = guessMimeType(path)
+    encoding = None
+    file = None
+    if isCompressibleType(mimeType):
+        # Serve a precompressed copy (from `flask compress-static`) if there is one
+        precompressed = findPrecompressed(path, fileStat)
+        if precompressed is not None:
+            file = openStaticFile(precompressed[1])
+            if file is not None:
+                encoding = precompressed[0]
+    if file is None:
+        file = openStaticFile(path)
+        if file is None:
+            return None
+    # The cached stat can be up to STATIC_STAT_TTL old, so the headers
+    # describe the file that was actually opened
+    fileStat = os.fstat(file.fileno())
+    response = Response(
+        wrap_file(request.environ, file),
+        mimetype=mimeType,
+        direct_passthrough=True,
+    )
+    response.content_length = fileStat.st_size
+    response.last_modified = fileStat.st_mtime
+    response.set_etag(f"{fileStat.st_mtime_ns:x}-{fileStat.st_size:x}")
+    if isCompressibleType(mimeType):
+        response.vary.add("Accept-Encoding")
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    if app.config["STATIC_MAX_AGE"] is None:
+        response.cache_control.no_cache = True
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config["STATIC_MAX_AGE"]
+    return response.make_conditional(
+        request.environ, accept_ranges=True, complete_length=fileStat.st_size
     )
 
 
+@app.route("/static/<path:filename>", methods=["GET"])
+def serveStatic(filename):
+    """Serve files from the static folder."""
+    path = safe_join(app.config["STATIC_FOLDER"], filename)
+    fileStat = statCache.get(path) if path else None
+    response = serveStaticFile(path, fileStat) if fileStat is not None else None
+    if response is None:
+        return serveErrorPage("404")
+    return response
+
+
 def getLuaErrorMessage(e):
     if showLuaErrors:
         return f"Error: {str(e)}"
     return "Error"
 
 
-def processCustomLuaTags(htmlContent):
-    def executeLuaCode(match):
-        # Capture Lua code and strip tags and extra whitespace
-        code = match.group(1).strip()
-        output = ""
+def formatShtmlError(e):
+    return f'<div class="_error">{getLuaErrorMessage(e)}</div>'
+
+
+def luaStringLiteral(text):
+    """Quote text as a Lua string literal that stays on one line."""
+    for char, escaped in (
+        ("\\", "\\\\"),
+        ('"', '\\"'),
+        ("\n", "\\n"),
+        ("\r", "\\r"),
+        ("\0", "\\000"),
+    ):
+        text = text.replace(char, escaped)
+    return f'"{text}"'
+
+
+def parseBlockAttributes(text):
+    """Attributes of a <$lua ...> tag as a dict, e.g. {"cache": "60", "async": True}."""
+    return {
+        name: value if assignment else True
+        for name, assignment, value in re.findall(r'([\w-]+)(\s*=\s*"([^"]*)")?', text)
+    }
+
+
+def compileShtml(htmlContent, name):
+    """Turn an .shtml file into Lua source for a single render function.
+
+    Static text becomes string constants and each <$lua>...<$> block becomes a
+    closure whose result (or error) is spliced into the output. Blocks can share
+    values through the page table. Newlines are kept in place so Lua error line
+    numbers match the .shtml file. <$lua cache="60"> blocks keep their output
+    in the api.cache store for that many seconds, and <$lua async> blocks are
+    returned separately as AsyncBlocks so they can run on other runtimes.
+    """
+    # Regex to capture content within <$lua ...>...<$>, with optional attributes
+    parts = re.split(
+        r'<\$lua((?:\s+[\w-]+(?:\s*=\s*"[^"]*")?)*\s*)>(.*?)<\$>',
+        htmlContent,
+        flags=re.DOTALL,
+    )
+    checkSyntax = currentLua().eval(
+        'function(code, name) local _, err = load(code, "@" .. name) return err end'
+    )
+
+    asyncBlocks = []
+    line = 0
+    source = [
+        "local formatError, fragments, startBlocks = ...; "
+        "local function finish(ok, value) if not ok then return formatError(value), false "
+        'elseif value == nil then return "", true else return tostring(value), true end end; '
+        "local function cached(key, ttl, block) local text = fragments.get(key); "
+        "if text == nil then local ok; text, ok = finish(pcall(block)); "
+        "if ok then fragments.set(key, text, ttl) end end; return text end; "
+        "return function(requestData) "
+        "local page, out, n = {}, {}, 0; "
+    ]
+    for index in range(0, len(parts), 3):
+        text = parts[index]
+        if text:
+            source.append(f"n = n + 1; out[n] = {luaStringLiteral(text)}; ")
+            source.append("\n" * text.count("\n"))
+            line += text.count("\n")
+        if index + 1 >= len(parts):
+            break
+
+        attributes = parseBlockAttributes(parts[index + 1])
+        if "\n" in parts[index + 1]:
+            # The tag itself spans lines
+            source.append("\n" * parts[index + 1].count("\n"))
+            line += parts[index + 1].count("\n")
+        part = parts[index + 2]
+        newlines = "\n" * part.count("\n")
+        # Checked the way the block is compiled below, padded so the error
+        # names the block's line in the .shtml file
+        end = "\nend" if attributes.get("async") else " end"
+        syntaxError = checkSyntax("\n" * line + f"return function() {part}{end}", name)
+        ttl = attributes.get("cache")
+        try:
+            ttl = float(ttl) if ttl is not None else None
+        except ValueError:
+            syntaxError = f'invalid cache attribute "{ttl}", it should be a number of seconds'
+        if syntaxError is not None:
+            # Keep the old behaviour: a broken block only breaks itself
+            part = f"error({luaStringLiteral(syntaxError)}, 0){newlines}"
+            attributes, ttl = {}, None
+        cacheKey = "_shtml:{}:{}:{}".format(
+            name, index // 3, hashlib.sha1(part.encode("utf-8")).hexdigest()[:16]
+        )
+
+        if attributes.get("async"):
+            asyncBlocks.append(
+                AsyncBlock(
+                    "\n" * line
+                    + f"local function block(requestData, page) {part}\nend "
+                    + "return function(...) local ok, value = pcall(block, ...) return ok, value end",
+                    name,
+                    cacheKey if ttl else None,
+                    ttl,
+                )
+            )
+            source.append(f"n = n + 1; out[n] = jobs.result({len(asyncBlocks) - 1}); {newlines}")
+        elif ttl:
+            source.append(
+                f"n = n + 1; out[n] = cached({luaStringLiteral(cacheKey)}, {ttl!r}, "
+                f"function() {part} end); "
+            )
+        else:
+            source.append(f"n = n + 1; out[n] = finish(pcall(function() {part} end)); ")
+        line += part.count("\n")
+    if asyncBlocks:
+        # Start the async blocks first, so they run while the rest renders
+        source.insert(1, "local jobs = startBlocks(); ")
+    source.append("return table.concat(out, '', 1, n) end")
+    return "".join(source), tuple(asyncBlocks)
+
+
+class FragmentCache:
+    """Output of <$lua cache="..."> blocks, kept in the api.cache store."""
+
+    @staticmethod
+    def get(key):
+        return keyValueStore.get(key)
+
+    @staticmethod
+    def set(key, text, ttl):
+        keyValueStore.set(key, text, expiresAt(ttl))
+
+
+class AsyncBlock:
+    """An <$lua async> block, compiled on whichever runtime ends up running it."""
+
+    def __init__(self, source, name, cacheKey, ttl):
+        self.source = source
+        self.name = name
+        self.cacheKey = cacheKey
+        self.ttl = ttl
+
+    def render(self, state):
+        """Run the block on state and return (text, whether it succeeded)."""
+        with useLuaState(state):
+            try:
+                function = state.compiledBlocks.get(self.source)
+                if function is None:
+                    if len(state.compiledBlocks) >= app.config["ROUTE_CACHE_SIZE"]:
+                        state.compiledBlocks.clear()
+                    function = state.compileChunk(self.source, self.name)
+                    state.compiledBlocks[self.source] = function
+                ok, value = function(getRequestData(), state.lua.table())
+            except Exception as e:
+                # Going over a limit fails the whole page, not just the block
+                if state.exceededLimit(e):
+                    raise
+                return formatShtmlError(e), False
+        if not ok:
+            if state.limits.exceeded:
+                raise LimitExceeded(state.limits.exceeded)
+            return formatShtmlError(value), False
+        if value is None:
+            return "", True
+        return state.lua.globals().tostring(value), True
+
+
+class AsyncBlockJobs:
+    """The async blocks of one page render, started together and collected in order.
+
+    Each block runs on a free runtime from the pool. When none is free, the
+    block is rendered in place on the page's own runtime when it is reached,
+    so a busy pool slows a page down instead of deadlocking it. Blocks get the
+    page's instruction limit and whatever is left of its time limit.
+    """
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.deadline = luaContext.state.deadline
+        self.results = {}
+        self.futures = {}
+        for index, block in enumerate(blocks):
+            if block.cacheKey is not None:
+                text = keyValueStore.get(block.cacheKey)
+                if text is not None:
+                    self.results[index] = text
+                    continue
+            state = luaPool.tryAcquire()
+            if state is not None:
+                self.futures[index] = fragmentExecutor.submit(
+                    copy_current_request_context(self.renderOn), state, block
+                )
+
+    def remaining(self):
+        """Seconds the page has left (0 = no time limit)."""
+        if self.deadline is None:
+            return 0
+        return max(self.deadline - time.monotonic(), 0.001)
+
+    def renderOn(self, state, block):
+        discard = False
         try:
-            # Execute only the Lua code, without tags
-            result = lua.execute(code)
-            output = str(result) if result is not None else ""
+            with state.limited(app.config["LUA_INSTRUCTION_LIMIT"], self.remaining()):
+                return block.render(state)
         except Exception as e:
-            # Insert error message if there's an execution error
-            output = f'<div class="_error">{getLuaErrorMessage(e)}</div>'
-        return output
+            exceeded = state.exceededLimit(e)
+            if exceeded == "memory":
+                # Only the block fails, but its runtime gets replaced
+                discard = True
+                return formatShtmlError(LIMIT_MESSAGES["memory"]), False
+            if exceeded:
+                raise LimitExceeded(exceeded) from None
+            raise
+        finally:
+            luaPool.release(state, discard)
+
+    def result(self, index):
+        if index in self.results:
+            return self.results[index]
+        block = self.blocks[index]
+        future = self.futures.get(index)
+        if future is not None:
+            try:
+                text, ok = future.result(self.remaining() or None)
+            except FutureTimeoutError:
+                raise LimitExceeded("timeout") from None
+        else:
+            text, ok = block.render(luaContext.state)
+        if ok and block.cacheKey is not None:
+            keyValueStore.set(block.cacheKey, text, expiresAt(block.ttl))
+        return text
 
-    # Regex to capture content within <$lua ... $> or <$lua>...</$>
-    processedContent = re.sub(
-        r"<\$lua\s*>(.*?)<\$>", executeLuaCode, htmlContent, flags=re.DOTALL
-    )
-    return processedContent
 
+def renderShtml(path):
+    """Render an .shtml file with its compiled template on the current runtime.
 
-def serveErrorPage(errorCode):
+    Returns None if the file was deleted since the route index last looked.
+    """
+    try:
+        template = luaContext.state.templateCache.get(path)
+    except FileNotFoundError:
+        routeIndex.invalidate(path)
+        return None
+    return template(getRequestData())
+
+
+def runShtmlFile(path, timeout, concurrency=0):
+    """Render an .shtml file on a runtime from the pool, within the route's limits.
+
+    Returns the page, None if the file is gone, or an error response if the
+    server is too busy or the page went over a limit.
+    """
+    rejected = admit(path, concurrency)
+    if rejected is not None:
+        return rejected
+    state = luaPool.acquire(admission.queueTimeout)
+    if state is None:
+        admission.release(path)
+        return serveOverloaded(os.path.relpath(path), "timeout")
+    discard = False
+    try:
+        with useLuaState(state):
+            with state.limited(
+                app.config["LUA_INSTRUCTION_LIMIT"],
+                timeout,
+                os.path.relpath(path) if shouldProfile() else None,
+            ):
+                return renderShtml(path)
+    except Exception as e:
+        exceeded = state.exceededLimit(e)
+        if exceeded is None:
+            raise
+        if exceeded == "memory":
+            discard = True
+        print("Lua Error:", LIMIT_MESSAGES[exceeded])
+        return handleLuaError(LIMIT_MESSAGES[exceeded], LIMIT_STATUS[exceeded])
+    finally:
+        luaPool.release(state, discard)
+        admission.release(path)
+
+
+def serveErrorPage(errorCode, headers=None):
     """Serve a custom error page manually, or a plain text response if unavailable."""
-    errorPath = os.path.join(app.config["ERRORS_FOLDER"], f"{errorCode}.html")
-    if os.path.isfile(errorPath):
-        with open(errorPath, "r") as file:
-            return Response(
-                file.read(), status=int(errorCode), content_type="text/html"
-            )
+    page = errorPages.get(errorCode)
+    if page is not None:
+        return Response(page, status=int(errorCode), content_type="text/html", headers=headers)
     return Response(
         f"Hi, the person who made this website forgot to make one specific error page, meaning this message is being shown.\nThis is the default error message on the server software made by a good person.\nThe code was: {errorCode}",
         status=int(errorCode),
         content_type="text/plain",
+        headers=headers,
     )
 
 
-def handleLuaError(e):
+def handleLuaError(e, status=500):
     """Attempt to serve luaError.html, then 500.html, with a final fallback to a plain text message."""
-    luaErrorPath = os.path.join(app.config["ERRORS_FOLDER"], "luaError.html")
-    if os.path.isfile(luaErrorPath):
-        with open(luaErrorPath, "r") as file:
-            return Response(
-                file.read().replace("<$error$>", getLuaErrorMessage(e)),
-                status=500,
-                content_type="text/html",
-            )
+    page = errorPages.get("luaError")
+    if page is not None:
+        return Response(
+            page.replace("<$error$>", getLuaErrorMessage(e)),
+            status=status,
+            content_type="text/html",
+        )
 
     return Response(
         "Well, the person who made this website decided to not make an error page.\nThere was an error with their code.\n "
         + getLuaErrorMessage(e),
-        status=500,
+        status=status,
         content_type="text/plain",
     )
 
 
-def handleLuaFile(path, requestData):
-    """Execute a Lua file and handle any errors during execution."""
-    try:
-        with app.app_context():  # Ensure Flask app context
-            with open(path, "r") as file:
-                luaScript = file.read()
+class LuaStream:
+    """A response body streamed from a Lua coroutine or iterator.
 
-            # Execute Lua script with request data
-            luaFunction = lua.execute(luaScript)
-            result = dict(luaFunction(requestData))
+    Chunks are made on the runtime that created the iterator, which stays
+    checked out until the server closes the response. Each chunk gets the
+    route's limits afresh, like asgi.py's streams.
+    """
 
+    def __init__(self, state, iterator, timeout=0, release=None):
+        self.state = state
+        self.iterator = iterator
+        self.timeout = timeout
+        self.release = release  # Also called on close, e.g. to free the admission slot
+        self.discard = False
+        self.closed = False
+
+    def __iter__(self):
+        state = self.state
+        with useLuaState(state):
+            try:
+                while True:
+                    with state.limited(app.config["LUA_INSTRUCTION_LIMIT"], self.timeout):
+                        chunk = self.iterator()
+                    if chunk is None:
+                        break
+                    if chunk != "":
+                        yield chunk if isinstance(chunk, (str, bytes)) else str(chunk)
+            except Exception as e:
+                if state.exceededLimit(e) == "memory":
+                    e = LIMIT_MESSAGES["memory"]
+                    self.discard = True
+                # Headers are already sent, so all we can do is end the stream
+                print("Lua Error while streaming:", e)
+
+    def close(self):
+        """Give the runtime back, once the response is done with it."""
+        if not self.closed:
+            self.closed = True
+            luaPool.release(self.state, self.discard)
+            if self.release is not None:
+                self.release()
+
+
+def handleLuaFile(path, timeout=0, release=None):
+    """Execute a Lua file and handle any errors during execution.
+
+    release is called once the request is done with its runtime, which for a
+    streamed response is when the stream closes.
+    """
+    route = os.path.relpath(path)
+    state = luaPool.acquire(admission.queueTimeout)  # Runtime reserved for this request
+    if state is None:
+        if release is not None:
+            release()
+        return serveOverloaded(route, "timeout")
+    discard = False
+    try:
+        with useLuaState(state):
+            buildStart = time.perf_counter()
+            requestData = getRequestData()
+            buildTime = time.perf_counter() - buildStart
+            with state.limited(
+                app.config["LUA_INSTRUCTION_LIMIT"],
+                timeout,
+                route if shouldProfile() else None,
+            ):
+                # Fetch the compiled handler, only recompiling when the file changed
+                with metrics.timer("luaflask_route_stage_seconds", route=route, stage="compile"):
+                    try:
+                        luaFunction = state.routeCache.get(path)
+                    except FileNotFoundError:
+                        # Deleted since the route index last looked
+                        routeIndex.invalidate(path)
+                        return serveErrorPage("404")
+                with metrics.timer("luaflask_route_stage_seconds", route=route, stage="execute"):
+                    result = dict(state.prepareResult(luaFunction(requestData)))
+
+            buildStart = time.perf_counter()
             if result is not None:
                 if "response" in result:
-                    return Response(
-                        result["response"],
+                    body = result["response"]
+                    if lua_type(body) == "function":
+                        # A coroutine or iterator: stream its chunks as they come
+                        body = LuaStream(state, body, timeout, release)
+                    response = Response(
+                        body,
                         status=result.get("code", 200),
                         content_type=result.get("type", "text/plain"),
-                        headers=result.get("headers", {}),
+                        headers=dict(result.get("headers") or {}),
+                    )
+                    if isinstance(body, LuaStream):
+                        # Closing the response closes the stream, which releases the runtime
+                        state = release = None
+                    else:
+                        responseCache.store(path, result.get("cache"), response)
+                    metrics.observe(
+                        "luaflask_route_stage_seconds",
+                        buildTime + time.perf_counter() - buildStart,
+                        route=route,
+                        stage="build",
                     )
+                    return response
                 elif "_redirect" in result:
                     return redirect(result["_redirect"])
             else:
@@ -663,51 +3466,241 @@ def handleLuaFile(path, requestData):
                 return serveErrorPage("500")
 
     except Exception as e:
+        exceeded = state.exceededLimit(e)
+        if exceeded == "memory":
+            # lupa's memory errors have no message. The runtime may also be
+            # left in a bad state, so it gets replaced
+            e = LIMIT_MESSAGES["memory"]
+            discard = True
         print("Lua Error:", e)
-        return handleLuaError(str(e))
+        return handleLuaError(str(e), LIMIT_STATUS.get(exceeded, 500))
+    finally:
+        if state is not None:
+            luaPool.release(state, discard)
+        if release is not None:
+            release()
+
+
+def routeTimeout(subpath):
+    return app.config["LUA_ROUTE_TIMEOUTS"].get(subpath.strip("/"), app.config["LUA_TIMEOUT"])
+
+
+def routeConcurrency(subpath, path):
+    """How many requests to this route may run at once (0 = only the overall limit)."""
+    configured = app.config["ROUTE_CONCURRENCY"].get(subpath.strip("/"))
+    if configured is not None:
+        return configured
+    return admission.declared.get(os.path.abspath(path), 0)
+
+
+def serveOverloaded(route, reason):
+    """The 503 sent when the server is too busy to take a request on."""
+    metrics.inc("luaflask_requests_shed_total", route=route, reason=reason)
+    return serveErrorPage(
+        "503", headers={"Retry-After": str(app.config["OVERLOAD_RETRY_AFTER"])}
+    )
+
+
+def admit(path, concurrency):
+    """Take an admission slot for path, or return the 503 to send if there isn't one."""
+    route = os.path.relpath(path)
+    waitStart = time.perf_counter()
+    rejected = admission.acquire(path, concurrency)
+    if rejected is not None:
+        return serveOverloaded(route, rejected)
+    metrics.observe("luaflask_queue_wait_seconds", time.perf_counter() - waitStart, route=route)
+    return None
+
+
+def releaseIfFailed(release, future):
+    """Give the slot back if the route failed before handleLuaFile could."""
+    if future.cancelled() or future.exception() is not None:
+        release()
+
+
+def closeAbandoned(future):
+    """Close the response nobody waited for, so a stream gives back what it holds."""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def runLuaFile(path, timeout, concurrency=0):
+    rejected = admit(path, concurrency)
+    if rejected is not None:
+        return rejected
+
+    # The slot stays taken until the route is done with its runtime, even if we
+    # stop waiting for it, and for a streamed response until the stream closes
+    release = admission.releaser(path)
+    # Run on the executor with this request's context available
+    handler = copy_current_request_context(handleLuaFile)
+    try:
+        future = executorQueue.submit(executor, handler, path, timeout, release)
+    except BaseException:
+        release()
+        raise
+    future.add_done_callback(partial(releaseIfFailed, release))
+    try:
+        return future.result(timeout or None)
+    except FutureTimeoutError:
+        # Stuck outside Lua (e.g. in a slow API call), the hook stops it once it's back
+        print("Lua Error: route timed out:", path)
+        future.add_done_callback(closeAbandoned)
+        return handleLuaError("Lua route timed out", 504)
+
+
+def refreshLuaFile(path, key, timeout, concurrency=0):
+    try:
+        # A refresh takes a slot like any request, and is skipped when there's no room
+        if admission.acquire(path, concurrency) is None:
+            handleLuaFile(path, timeout, admission.releaser(path)).close()
+    finally:
+        responseCache.endRefresh(key)
+
+
+def serveCachedLuaFile(path, timeout, concurrency=0):
+    """Serve a route from the response cache, rendering it once per miss."""
+    key = responseCache.keyFor(path)
+    entry = responseCache.get(key)
+    if entry is None:
+        with responseCache.flight(key, admission.queueTimeout) as outcome:
+            if outcome == "timeout":
+                return serveOverloaded(os.path.relpath(path), "timeout")
+            # Another request may have rendered it while this one waited
+            entry = responseCache.get(key)
+            if entry is None:
+                metrics.inc("luaflask_response_cache_total", result="miss")
+                return runLuaFile(path, timeout, concurrency)
+
+    if not entry.isFresh():
+        metrics.inc("luaflask_response_cache_total", result="stale")
+        if responseCache.startRefresh(key):
+            # Stale-while-revalidate: serve the old copy and refresh in the background
+            executorQueue.submit(
+                executor,
+                copy_current_request_context(refreshLuaFile),
+                path,
+                key,
+                timeout,
+                concurrency,
+            )
+    else:
+        metrics.inc("luaflask_response_cache_total", result="hit")
+    return entry.toResponse()
 
 
 @app.route("/<path:subpath>", methods=["GET", "POST", "PUT", "DELETE"])
 @app.route("/", defaults={"subpath": ""}, methods=["GET", "POST", "PUT", "DELETE"])
 def routeHandler(subpath):
     """Handle routes by serving Lua scripts or other files in the routes folder."""
-    if subpath == "":
-        luaPath = os.path.join(app.config["ROUTES_FOLDER"], "_.lua")
-    else:
-        luaPath = os.path.join(app.config["ROUTES_FOLDER"], subpath, "_.lua")
-
-    # If default route file doesn’t exist, check for specific file
-    if not os.path.isfile(luaPath):
-        luaPath = os.path.join(app.config["ROUTES_FOLDER"], f"{subpath}.lua")
+    lookupStart = time.perf_counter()
+    route = routeIndex.resolve(subpath)
+    if route is None:
+        # Fallback to 404 if file not found
+        return serveErrorPage("404")
+    kind, path = route
+    g.metricsRoute = os.path.relpath(path)
+    metrics.observe(
+        "luaflask_route_stage_seconds",
+        time.perf_counter() - lookupStart,
+        route=g.metricsRoute,
+        stage="lookup",
+    )
 
-    if os.path.isfile(luaPath):
-        requestData = getRequestData()
-        return executor.submit(handleLuaFile, luaPath, requestData).result()
+    if kind == "lua":
+        timeout = routeTimeout(subpath)
+        concurrency = routeConcurrency(subpath, path)
+        if responseCache.isCacheable(path):
+            return serveCachedLuaFile(path, timeout, concurrency)
+        return runLuaFile(path, timeout, concurrency)
 
     # If the route is a .shtml file, process embedded Lua tags
-    if subpath.endswith(".shtml"):
-        shtmlPath = os.path.join(app.config["ROUTES_FOLDER"], subpath)
-        if os.path.isfile(shtmlPath):
-            with open(shtmlPath, "r") as file:
-                htmlContent = file.read()
+    if kind == "shtml":
+        processedContent = runShtmlFile(
+            path, routeTimeout(subpath), routeConcurrency(subpath, path)
+        )
+        if processedContent is None:
+            return serveErrorPage("404")
+        if isinstance(processedContent, Response):
+            return processedContent
+
+        return Response(processedContent, content_type="text/html")
+
+    # Serve non-Lua files directly
+    fileStat = statCache.get(path)
+    response = serveStaticFile(path, fileStat) if fileStat is not None else None
+    if response is None:
+        routeIndex.invalidate(path)
+        return serveErrorPage("404")
+    return response
+
+
+@app.after_request
+def compressResponseBody(response):
+    return compressResponse(response)
+
+
+@app.cli.command("compress-static")
+def compressStaticCommand():
+    """Write .gz/.br copies of the static files next to them."""
+    written = precompressFiles([app.config["STATIC_FOLDER"], app.config["ROUTES_FOLDER"]])
+    print(f"Wrote {written} compressed files.")
+
+
+if app.config["STATIC_PRECOMPRESS"]:
+    precompressFiles([app.config["STATIC_FOLDER"], app.config["ROUTES_FOLDER"]])
+
+
+@app.before_request
+def ensureBackgroundThreads():
+    if backgroundPid != os.getpid():
+        startBackgroundThreads()
+
+
+@app.before_request
+def startRequestTimer():
+    g.requestStart = time.perf_counter()
+
+
+@app.after_request
+def recordRequestMetrics(response):
+    if "requestStart" in g:
+        # Routes outside the routes folder are labelled by their URL rule
+        route = g.get("metricsRoute")
+        if route is None:
+            route = request.url_rule.rule if request.url_rule else "none"
+        metrics.inc("luaflask_requests_total", route=route, status=response.status_code)
+        metrics.observe(
+            "luaflask_request_duration_seconds",
+            time.perf_counter() - g.requestStart,
+            route=route,
+        )
+    return response
+
+
+def serveMetrics():
+    """Serve every metric in the Prometheus text format."""
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4")
+
+
+if app.config["METRICS_PATH"]:
+    app.add_url_rule(app.config["METRICS_PATH"], "metrics", serveMetrics)
 
-            # Process embedded Lua tags in .shtml file
-            processedContent = processCustomLuaTags(htmlContent)
 
-            return Response(processedContent, content_type="text/html")
+def serveProfile():
+    """Serve the collected profiles as collapsed stacks, optionally for one route.
 
-    # Serve non-Lua files directly if available
-    otherFilePath = os.path.join(app.config["ROUTES_FOLDER"], subpath)
-    if os.path.isfile(otherFilePath):
-        with open(otherFilePath, "rb") as file:
-            # Guess the content type based on file extension
-            mimeType, _ = mimetypes.guess_type(otherFilePath)
-            contentType = mimeType if mimeType else "application/octet-stream"
+    ?route=routes/page.lua limits it to one route file and ?reset=1 clears
+    the profiles after serving them.
+    """
+    body = profiler.collapsed(request.args.get("route"))
+    if request.args.get("reset") == "1":
+        profiler.reset()
+    return Response(body, content_type="text/plain")
 
-            return Response(file.read(), content_type=contentType)
 
-    # Fallback to 404 if file not found
-    return serveErrorPage("404")
+if app.config["PROFILING_ENABLED"]:
+    app.add_url_rule(app.config["PROFILE_PATH"], "profile", serveProfile)
 
 
 # Set a generic error handler that captures all HTTP errors
@@ -0,0 +1,227 @@
+import argparse
+import os
+import random
+import signal
+import socket
+import threading
+import time
+import _thread
+
+import waitress
+from werkzeug.wsgi import ClosingIterator
+
+# Importing main here runs the one-time setup (database, module checks) in the
+# master. Lua runtimes and background threads are only created once requests
+# come in, so the master forks without them and every worker builds its own.
+import main
+
+# A worker that crashes within this many seconds of starting failed to start,
+# and is respawned after a delay that doubles up to MAX_RESPAWN_DELAY
+STARTUP_PERIOD = 5
+MAX_RESPAWN_DELAY = 30
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(
+        description="Run LuaFlask as a master process with several worker processes."
+    )
+    parser.add_argument("--listen", default="*:80", help="host:port to listen on")
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1, help="worker processes"
+    )
+    parser.add_argument(
+        "--threads", type=int, default=4, help="waitress threads per worker"
+    )
+    parser.add_argument(
+        "--max-requests",
+        type=int,
+        default=0,
+        help="restart a worker after this many requests (0 = never)",
+    )
+    parser.add_argument(
+        "--max-requests-jitter",
+        type=int,
+        default=0,
+        help="random extra requests per worker so they don't all restart together",
+    )
+    parser.add_argument(
+        "--graceful-timeout",
+        type=float,
+        default=30,
+        help="seconds a stopping worker gets to finish its requests",
+    )
+    return parser.parse_args()
+
+
+def createSocket(listen):
+    host, _, port = listen.rpartition(":")
+    if host in ("", "*"):
+        host = ""
+    sock = socket.create_server((host.strip("[]"), int(port)), backlog=1024)
+    sock.set_inheritable(True)
+    return sock
+
+
+class Worker:
+    """Runs inside a forked process: serves the shared socket until told to stop."""
+
+    def __init__(self, sock, args):
+        self.sock = sock
+        self.args = args
+        self.maxRequests = 0
+        if args.max_requests:
+            self.maxRequests = args.max_requests + random.randint(
+                0, args.max_requests_jitter
+            )
+        self.served = 0
+        self.active = 0
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.server = None
+
+    def app(self, environ, start_response):
+        with self.lock:
+            self.served += 1
+            self.active += 1
+            recycle = self.maxRequests and self.served >= self.maxRequests
+        if recycle:
+            self.stop()
+
+        try:
+            body = main.app(environ, start_response)
+        except BaseException:
+            self.finishRequest()
+            raise
+        return ClosingIterator(body, [self.finishRequest])
+
+    def finishRequest(self):
+        with self.lock:
+            self.active -= 1
+
+    def stop(self, *_):
+        """Stop accepting connections and exit once in-flight requests are done."""
+        if self.stopping:
+            return
+        self.stopping = True
+        self.server.accepting = False
+        threading.Thread(target=self.drain, daemon=True).start()
+
+    def drain(self):
+        deadline = time.monotonic() + self.args.graceful_timeout
+        while self.active > 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        # Give waitress a moment to flush the last responses, then stop its loop
+        time.sleep(0.1)
+        _thread.interrupt_main()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        main.initWorker()
+        self.server = waitress.create_server(
+            self.app, sockets=[self.sock], threads=self.args.threads
+        )
+        self.server.run()
+
+
+class Master:
+    """Forks the workers, replaces them when they exit and restarts them on SIGHUP."""
+
+    def __init__(self, args):
+        self.args = args
+        self.sock = createSocket(args.listen)
+        self.workers = set()
+        self.started = {}  # pid -> time it was forked
+        self.running = True
+        self.respawnDelay = 0
+        self.respawnAt = 0
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                Worker(self.sock, self.args).run()
+            except Exception as e:
+                print(f"Worker {os.getpid()} crashed:", e)
+                code = 1
+            finally:
+                os._exit(code)
+        self.workers.add(pid)
+        self.started[pid] = time.monotonic()
+
+    def signalWorkers(self, signum, workers=None):
+        for pid in list(self.workers if workers is None else workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                self.workers.discard(pid)
+                self.started.pop(pid, None)
+
+    def reload(self, *_):
+        """Start a fresh set of workers, then let the old ones finish and exit."""
+        print("Reloading workers...")
+        oldWorkers = set(self.workers)
+        for _ in range(self.args.workers):
+            self.spawn()
+        self.signalWorkers(signal.SIGTERM, oldWorkers)
+
+    def shutdown(self, *_):
+        self.running = False
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self.workers.discard(pid)
+            started = self.started.pop(pid, None)
+            now = time.monotonic()
+            if (
+                os.waitstatus_to_exitcode(status) != 0
+                and started is not None
+                and now - started < STARTUP_PERIOD
+                and now >= self.respawnAt  # Back off once per round of respawns
+            ):
+                self.respawnDelay = min(self.respawnDelay * 2 or 0.5, MAX_RESPAWN_DELAY)
+                self.respawnAt = now + self.respawnDelay
+                print(f"Worker {pid} failed to start, retrying in {self.respawnDelay:g}s")
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.shutdown)
+        signal.signal(signal.SIGINT, self.shutdown)
+        signal.signal(signal.SIGHUP, self.reload)
+        print(
+            f"Serving on {self.args.listen} with {self.args.workers} workers "
+            f"(master pid {os.getpid()})"
+        )
+
+        while self.running:
+            self.reap()
+            now = time.monotonic()
+            if self.respawnDelay and any(
+                now - started >= STARTUP_PERIOD for started in self.started.values()
+            ):
+                # A worker got through startup, so stop backing off
+                self.respawnDelay = 0
+            # Replace workers that exited (recycled or crashed)
+            if now >= self.respawnAt:
+                while len(self.workers) < self.args.workers:
+                    self.spawn()
+            time.sleep(0.2)
+
+        self.signalWorkers(signal.SIGTERM)
+        deadline = time.monotonic() + self.args.graceful_timeout + 1
+        while self.workers and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        self.signalWorkers(signal.SIGKILL)
+        self.sock.close()
+
+
+if __name__ == "__main__":
+    Master(parseArgs()).run()